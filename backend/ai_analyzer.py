@@ -1,9 +1,72 @@
 import os
-from typing import List, Dict
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
+from typing import List, Dict, Iterator, Optional, Tuple
+
+from response_cache import response_cache, summary_cache
+
+ANALYSIS_MODEL = "gpt-4-turbo-preview"
+
+# tiktoken is optional; without it token counts are estimated from character counts
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+def _get_encoding():
+    """tiktoken encoding for the analysis model, or None if tiktoken is unavailable"""
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            _encoding_loaded = True
+            if tiktoken is not None:
+                try:
+                    _encoding = tiktoken.encoding_for_model(ANALYSIS_MODEL)
+                except Exception as e:
+                    # e.g. the encoding file cannot be downloaded
+                    print(f"tiktoken unavailable, estimating token counts: {e}")
+        return _encoding
+
+# Map-reduce analysis summarizes batches on this shared pool, which caps concurrent summary calls across requests
+MAP_CONCURRENCY = int(os.getenv("ANALYSIS_MAP_CONCURRENCY", "4"))
+_map_executor = ThreadPoolExecutor(max_workers=MAP_CONCURRENCY, thread_name_prefix="analysis-map")
+
+MAP_SYSTEM_MESSAGE = """You summarize one batch of a project's emails and documents (or of earlier batch summaries).
+            The summaries of all batches are combined later to answer questions about the whole project, so keep
+            names, dates, figures, decisions, requests and open issues, and say which email subject or document
+            name each point comes from."""
+
+def email_source(email: Dict) -> str:
+    return f"Email \"{email.get('subject', 'No Subject')}\" from {email.get('from_', 'Unknown')} ({email.get('date', 'Unknown')})"
+
+def document_source(doc: Dict) -> str:
+    return f"Document \"{doc.get('name', 'Untitled')}\" ({doc.get('type', 'Unknown')}, modified {doc.get('modified_time', 'Unknown')})"
 
 class AIAnalyzer:
     """AI-powered analysis of emails and documents"""
     
+    # Prompt tokens for an analysis request (system message, history, context and query)
+    CONTEXT_TOKEN_BUDGET = int(os.getenv("ANALYSIS_CONTEXT_TOKENS", "12000"))
+    # Budget shares, filled in priority order; unused budget then goes to sections with material left
+    CONTEXT_PRIORITY = ['content', 'history', 'metadata']
+    CONTEXT_SHARES = {'content': 0.6, 'history': 0.25, 'metadata': 0.15}
+    # Content pieces are cut to fit only if at least this many tokens are left
+    MIN_TRUNCATED_TOKENS = 100
+    # Sampling settings for analysis completions
+    COMPLETION_SETTINGS = {'max_tokens': 1500, 'temperature': 0.7}
+    # Map-reduce mode: prompt tokens per batch summary request, and sampling settings for summaries
+    MAP_BATCH_TOKENS = int(os.getenv("ANALYSIS_MAP_BATCH_TOKENS", "6000"))
+    MAP_SETTINGS = {'max_tokens': 500, 'temperature': 0.2}
+    # A half-full batch also ends after an item whose key hashes to a boundary (about 1 in MAP_BOUNDARY_ITEMS),
+    # so adding or changing an item only shifts the batches around it
+    MAP_BOUNDARY_ITEMS = 8
+    
     def __init__(self):
         # Initialize OpenAI client
         # You can set OPENAI_API_KEY environment variable or pass it here
@@ -20,11 +83,299 @@ class AIAnalyzer:
         else:
             self.client = None
             self.enabled = False
+        
+        # Filled in by build_messages and by analyze_data / analyze_data_stream
+        self.last_context_usage = None
+        self.last_cache_hit = False
+        # Optional callback(stage, data) for long-running steps, e.g. map-reduce batch summaries
+        self.on_progress = None
+    
+    def count_tokens(self, text: str) -> int:
+        """Tokens in text for the analysis model (tiktoken if installed, else ~4 characters per token)"""
+        encoding = _get_encoding()
+        if encoding is None:
+            return (len(text) + 3) // 4
+        return len(encoding.encode(text, disallowed_special=()))
+    
+    def truncate_tokens(self, text: str, max_tokens: int) -> str:
+        encoding = _get_encoding()
+        if encoding is None:
+            return text[:max_tokens * 4]
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    
+    def _fill(self, pieces: List[tuple], start: int, limit: int, truncate: bool) -> tuple:
+        """Take (value, tokens) pieces from start while they fit in limit tokens
+        
+        With truncate, the first piece that does not fit is cut to the remaining budget.
+        Returns (values, tokens used, index of the next piece).
+        """
+        values, used, index = [], 0, start
+        while index < len(pieces):
+            value, tokens = pieces[index]
+            if used + tokens <= limit:
+                values.append(value)
+                used += tokens
+                index += 1
+                continue
+            remaining = limit - used
+            if truncate and remaining >= self.MIN_TRUNCATED_TOKENS:
+                values.append(self.truncate_tokens(value, remaining - 3) + " [...]")
+                used = limit
+                index += 1
+            break
+        return values, used, index
+    
+    def build_messages(self, prompt: str, emails: List[Dict], documents: List[Dict],
+                       email_contents: Dict[str, str] = None,
+                       document_contents: Dict[str, str] = None,
+                       conversation_history: List[Dict] = None,
+                       relevant_chunks: List[Dict] = None,
+                       summaries: List[str] = None) -> List[Dict]:
+        """Build the chat messages for an analysis request (arguments as for analyze_data)
+        
+        The context is packed into CONTEXT_TOKEN_BUDGET tokens. Content (batch summaries, search
+        excerpts or parsed text), conversation history (newest first) and the item list each get their
+        CONTEXT_SHARES of the budget in that priority order, then unused budget goes to
+        whatever still has material. How the budget was spent is left in last_context_usage.
+        """
+        # Create the system message
+        system_message = """You are an AI assistant helping to analyze emails and documents. 
+            You have access to email and document metadata, and in some cases, their full content.
+            Your task is to answer questions about this data, find patterns, summarize information,
+            and provide insights based on the user's query. Be specific and reference the actual data.
+            You can remember context from previous messages in the conversation."""
+        
+        # Content: map-reduce batch summaries, excerpts retrieved from the project's search index,
+        # or the parsed text of selected items
+        content = []
+        parsed_fallback = []
+        if summaries is not None:
+            content = list(summaries)
+        elif relevant_chunks:
+            covered = set()
+            for chunk in relevant_chunks:
+                item = chunk.get('item', {})
+                source = email_source(item) if chunk['source_type'] == 'email' else document_source(item)
+                content.append(f"{source}:\n{chunk['content']}")
+                if chunk.get('chunk_index', 0) > 0:
+                    covered.add((chunk['source_type'], chunk['source_id']))
+            # Text the user asked to parse is kept even when retrieval matched none of its body chunks
+            for email in emails:
+                if email_contents and email_contents.get(email.get('id')) and ('email', email['id']) not in covered:
+                    parsed_fallback.append(f"{email_source(email)}:\n{email_contents[email['id']]}")
+            for doc in documents:
+                if document_contents and document_contents.get(doc.get('id')) and ('document', doc['id']) not in covered:
+                    parsed_fallback.append(f"{document_source(doc)}:\n{document_contents[doc['id']]}")
+        else:
+            for email in emails:
+                if email_contents and email_contents.get(email.get('id')):
+                    content.append(f"{email_source(email)}:\n{email_contents[email['id']]}")
+            for doc in documents:
+                if document_contents and document_contents.get(doc.get('id')):
+                    content.append(f"{document_source(doc)}:\n{document_contents[doc['id']]}")
+        
+        # Item list: emails and documents alternated so neither crowds out the other
+        listing = []
+        for email, doc in zip_longest(emails, documents):
+            if email:
+                listing.append(f"- {email_source(email)}: {email.get('snippet', '')}")
+            if doc:
+                listing.append(f"- {document_source(doc)}")
+        
+        # Messages carry a few tokens of overhead each
+        sections = {
+            'content': [(text, self.count_tokens(text) + 2) for text in content],
+            'history': [
+                (message, self.count_tokens(message['content']) + 4)
+                for message in reversed(conversation_history or [])
+            ],
+            'metadata': [(line, self.count_tokens(line) + 1) for line in listing],
+        }
+        
+        query = f"\n\nUser Query: {prompt}"
+        fixed = self.count_tokens(system_message) + self.count_tokens(query) + 20
+        available = max(0, self.CONTEXT_TOKEN_BUDGET - fixed)
+        
+        if parsed_fallback:
+            # Parsed items lacking an excerpt go first, sharing at most half of the content share
+            # so they cannot crowd out the excerpts
+            per_item = int(available * self.CONTEXT_SHARES['content'] / 2 / len(parsed_fallback))
+            fallback_pieces = []
+            for text in parsed_fallback:
+                tokens = self.count_tokens(text) + 2
+                if tokens > per_item:
+                    text = self.truncate_tokens(text, max(per_item - 5, 0)) + " [...]"
+                    tokens = self.count_tokens(text) + 2
+                fallback_pieces.append((text, tokens))
+            sections['content'] = fallback_pieces + sections['content']
+        
+        packed = {name: [] for name in sections}
+        used = {name: 0 for name in sections}
+        next_piece = {name: 0 for name in sections}
+        for final_pass in (False, True):
+            for name in self.CONTEXT_PRIORITY:
+                spare = available - sum(used.values())
+                limit = spare if final_pass else min(spare, int(available * self.CONTEXT_SHARES[name]))
+                values, tokens, next_piece[name] = self._fill(
+                    sections[name], next_piece[name], limit, truncate=final_pass and name == 'content'
+                )
+                packed[name].extend(values)
+                used[name] += tokens
+        
+        context_parts = [f"PROJECT DATA: {len(emails)} emails and {len(documents)} documents."]
+        if packed['content']:
+            if summaries is not None:
+                heading = "SUMMARIES COVERING ALL ITEMS"
+            else:
+                heading = "MOST RELEVANT EXCERPTS" if relevant_chunks else "PARSED CONTENT"
+            context_parts.append(f"\n{heading}:")
+            context_parts.extend(f"{i}. {text}\n" for i, text in enumerate(packed['content'], 1))
+        if packed['metadata']:
+            context_parts.append(f"\nITEMS ({len(packed['metadata'])} of {len(listing)} listed):")
+            context_parts.extend(packed['metadata'])
+        context = "\n".join(context_parts)
+        
+        self.last_context_usage = {
+            'budget': self.CONTEXT_TOKEN_BUDGET,
+            'fixed': fixed,
+            'tokenizer': 'tiktoken' if _get_encoding() is not None else 'estimate',
+            'sections': {
+                name: {'tokens': used[name], 'included': len(packed[name]), 'available': len(sections[name])}
+                for name in sections
+            },
+            'total': fixed + sum(used.values())
+        }
+        
+        # Build messages list with conversation history (oldest first)
+        messages = [{"role": "system", "content": system_message}]
+        messages.extend(reversed(packed['history']))
+        
+        # Add current context and user query
+        messages.append({
+            "role": "user", 
+            "content": f"Context:\n{context}{query}"
+        })
+        
+        return messages
+    
+    def corpus_items(self, emails: List[Dict], documents: List[Dict],
+                     email_contents: Dict[str, str] = None,
+                     document_contents: Dict[str, str] = None) -> List[Tuple[str, str]]:
+        """(key, text) for every email and document, using parsed content where available"""
+        items = []
+        for email in emails:
+            content = (email_contents or {}).get(email.get('id')) or email.get('snippet', '')
+            items.append((f"email:{email.get('id')}", f"{email_source(email)}:\n{content}"))
+        for doc in documents:
+            content = (document_contents or {}).get(doc.get('id'))
+            text = f"{document_source(doc)}:\n{content}" if content else document_source(doc)
+            items.append((f"document:{doc.get('id')}", text))
+        return items
+    
+    def make_batches(self, pieces: List[Tuple[str, str, int]], limit: int) -> List[List[str]]:
+        """Group (key, text, tokens) pieces in order into batches of at most limit tokens"""
+        batches, batch, used = [], [], 0
+        for key, text, tokens in pieces:
+            if batch and used + tokens > limit:
+                batches.append(batch)
+                batch, used = [], 0
+            batch.append(text)
+            used += tokens
+            boundary = int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % self.MAP_BOUNDARY_ITEMS == 0
+            if boundary and used * 2 >= limit:
+                batches.append(batch)
+                batch, used = [], 0
+        if batch:
+            batches.append(batch)
+        return batches
+    
+    def summarize_batch(self, batch: List[str]) -> Tuple[Optional[str], bool]:
+        """Summarize one batch, reusing a cached summary of the same texts. Returns (summary or None, cached)"""
+        messages = [
+            {"role": "system", "content": MAP_SYSTEM_MESSAGE},
+            {"role": "user", "content": "\n\n".join(batch)}
+        ]
+        cache_key = summary_cache.make_key(ANALYSIS_MODEL, self.MAP_SETTINGS, messages, '')
+        cached = summary_cache.get(cache_key)
+        if cached is not None:
+            return cached, True
+        try:
+            response = self.client.chat.completions.create(
+                model=ANALYSIS_MODEL,
+                messages=messages,
+                **self.MAP_SETTINGS
+            )
+            summary = response.choices[0].message.content
+        except Exception as e:
+            print(f"Batch summary failed: {e}")
+            return None, False
+        summary_cache.put(cache_key, ANALYSIS_MODEL, summary)
+        return summary, False
+    
+    def summarize_corpus(self, items: List[Tuple[str, str]]) -> Tuple[List[str], Dict]:
+        """Map step: summarize items in token-bounded batches, in parallel on the shared map pool
+        
+        Summaries are summarized again until they fit the content share of the context budget.
+        Returns the summaries and counters for last_context_usage.
+        """
+        limit = self.MAP_BATCH_TOKENS - self.count_tokens(MAP_SYSTEM_MESSAGE) - 20
+        target = int(self.CONTEXT_TOKEN_BUDGET * self.CONTEXT_SHARES['content'])
+        usage = {'items': len(items), 'batches': 0, 'cached': 0, 'summarized': 0, 'failed': 0, 'rounds': 0}
+        
+        pieces = []
+        for key, text in items:
+            tokens = self.count_tokens(text) + 2
+            if tokens > limit:
+                text, tokens = self.truncate_tokens(text, limit - 5) + " [...]", limit
+            pieces.append((key, text, tokens))
+        
+        while pieces:
+            batches = self.make_batches(pieces, limit)
+            usage['rounds'] += 1
+            usage['batches'] += len(batches)
+            summaries = []
+            for done, (summary, cached) in enumerate(_map_executor.map(self.summarize_batch, batches), 1):
+                if self.on_progress:
+                    self.on_progress('summarizing', {'round': usage['rounds'], 'batches_done': done, 'batches': len(batches)})
+                if summary is None:
+                    usage['failed'] += 1
+                    continue
+                usage['cached' if cached else 'summarized'] += 1
+                summaries.append(summary)
+            
+            done = len(summaries) <= 1 or len(summaries) >= len(pieces)
+            pieces = [(summary, summary, self.count_tokens(summary) + 2) for summary in summaries]
+            if done or sum(tokens for _, _, tokens in pieces) <= target:
+                break
+        
+        return [text for _, text, _ in pieces], usage
+    
+    def _analysis_messages(self, prompt: str, emails: List[Dict], documents: List[Dict],
+                           email_contents: Dict[str, str], document_contents: Dict[str, str],
+                           conversation_history: List[Dict], relevant_chunks: List[Dict],
+                           map_reduce: bool) -> List[Dict]:
+        if not map_reduce:
+            return self.build_messages(
+                prompt, emails, documents, email_contents, document_contents, conversation_history, relevant_chunks
+            )
+        
+        # Reduce step: answer from summaries that cover every item
+        summaries, usage = self.summarize_corpus(
+            self.corpus_items(emails, documents, email_contents, document_contents)
+        )
+        messages = self.build_messages(
+            prompt, emails, documents, conversation_history=conversation_history, summaries=summaries
+        )
+        self.last_context_usage['map_reduce'] = usage
+        return messages
     
     def analyze_data(self, prompt: str, emails: List[Dict], documents: List[Dict], 
                      email_contents: Dict[str, str] = None, 
                      document_contents: Dict[str, str] = None,
-                     conversation_history: List[Dict] = None) -> str:
+                     conversation_history: List[Dict] = None,
+                     relevant_chunks: List[Dict] = None,
+                     use_cache: bool = True,
+                     map_reduce: bool = False) -> str:
         """
         Analyze emails and documents based on user prompt
         
@@ -35,6 +386,10 @@ class AIAnalyzer:
             email_contents: Optional dict of email_id -> full email content
             document_contents: Optional dict of doc_id -> full document content
             conversation_history: Optional list of previous messages for context
+            relevant_chunks: Optional search index excerpts to use as context instead of parsed content
+            use_cache: Reuse a cached answer to an identical request (see response_cache.py)
+            map_reduce: Summarize every item in batches and answer from the summaries instead of
+                        relevant_chunks; batch summaries are cached whatever use_cache says
         
         Returns:
             AI-generated analysis response
@@ -42,78 +397,90 @@ class AIAnalyzer:
         if not self.enabled:
             return "AI analysis is not available. Please set OPENAI_API_KEY environment variable."
         
+        self.last_cache_hit = False
         try:
-            # Build context from available data
-            context_parts = []
-            
-            # Add email summaries
-            if emails:
-                context_parts.append(f"EMAILS ({len(emails)} total):")
-                for i, email in enumerate(emails[:20], 1):  # Limit to 20 for context
-                    email_info = f"{i}. Subject: {email.get('subject', 'No Subject')}\n"
-                    email_info += f"   From: {email.get('from_', 'Unknown')}\n"
-                    email_info += f"   Date: {email.get('date', 'Unknown')}\n"
-                    email_info += f"   Preview: {email.get('snippet', '')}\n"
-                    
-                    # Add full content if available
-                    if email_contents and email.get('id') in email_contents:
-                        full_content = email_contents[email['id']]
-                        if full_content:
-                            email_info += f"   Full Content: {full_content[:500]}...\n"
-                    
-                    context_parts.append(email_info)
-            
-            # Add document summaries
-            if documents:
-                context_parts.append(f"\nDOCUMENTS ({len(documents)} total):")
-                for i, doc in enumerate(documents[:20], 1):  # Limit to 20 for context
-                    doc_info = f"{i}. Name: {doc.get('name', 'Untitled')}\n"
-                    doc_info += f"   Type: {doc.get('type', 'Unknown')}\n"
-                    doc_info += f"   Modified: {doc.get('modified_time', 'Unknown')}\n"
-                    
-                    # Add parsed content if available
-                    if document_contents and doc.get('id') in document_contents:
-                        content = document_contents[doc['id']]
-                        if content:
-                            doc_info += f"   Content Preview: {content[:500]}...\n"
-                    
-                    context_parts.append(doc_info)
-            
-            context = "\n".join(context_parts)
-            
-            # Create the system message
-            system_message = """You are an AI assistant helping to analyze emails and documents. 
-            You have access to email and document metadata, and in some cases, their full content.
-            Your task is to answer questions about this data, find patterns, summarize information,
-            and provide insights based on the user's query. Be specific and reference the actual data.
-            You can remember context from previous messages in the conversation."""
-            
-            # Build messages list with conversation history
-            messages = [{"role": "system", "content": system_message}]
-            
-            # Add conversation history if provided
-            if conversation_history:
-                messages.extend(conversation_history)
+            messages = self._analysis_messages(
+                prompt, emails, documents, email_contents, document_contents,
+                conversation_history, relevant_chunks, map_reduce
+            )
             
-            # Add current context and user query
-            messages.append({
-                "role": "user", 
-                "content": f"Context:\n{context}\n\nUser Query: {prompt}"
-            })
+            cache_key = response_cache.make_key(ANALYSIS_MODEL, self.COMPLETION_SETTINGS, messages, prompt)
+            if use_cache:
+                cached = response_cache.get(cache_key)
+                if cached is not None:
+                    self.last_cache_hit = True
+                    return cached
+            else:
+                response_cache.bypass()
             
             # Create the completion
             response = self.client.chat.completions.create(
-                model="gpt-4-turbo-preview",  # or "gpt-3.5-turbo" for faster/cheaper
+                model=ANALYSIS_MODEL,  # or "gpt-3.5-turbo" for faster/cheaper
                 messages=messages,
-                max_tokens=1500,
-                temperature=0.7
+                **self.COMPLETION_SETTINGS
             )
             
-            return response.choices[0].message.content
-            
+            analysis = response.choices[0].message.content
+            response_cache.put(cache_key, ANALYSIS_MODEL, analysis)
+            return analysis
+        
         except Exception as e:
             return f"Error performing AI analysis: {str(e)}"
     
+    def analyze_data_stream(self, prompt: str, emails: List[Dict], documents: List[Dict],
+                            email_contents: Dict[str, str] = None,
+                            document_contents: Dict[str, str] = None,
+                            conversation_history: List[Dict] = None,
+                            relevant_chunks: List[Dict] = None,
+                            use_cache: bool = True,
+                            map_reduce: bool = False) -> Iterator[str]:
+        """Like analyze_data, but yield the response text piece by piece as the model produces it
+        
+        In map-reduce mode the batches are summarized before the answer starts streaming.
+        A cached answer is yielded in one piece. Closing the generator closes the underlying
+        HTTP stream; only answers streamed to the end are cached.
+        """
+        if not self.enabled:
+            yield "AI analysis is not available. Please set OPENAI_API_KEY environment variable."
+            return
+        
+        self.last_cache_hit = False
+        stream = None
+        try:
+            messages = self._analysis_messages(
+                prompt, emails, documents, email_contents, document_contents,
+                conversation_history, relevant_chunks, map_reduce
+            )
+            
+            cache_key = response_cache.make_key(ANALYSIS_MODEL, self.COMPLETION_SETTINGS, messages, prompt)
+            if use_cache:
+                cached = response_cache.get(cache_key)
+                if cached is not None:
+                    self.last_cache_hit = True
+                    yield cached
+                    return
+            else:
+                response_cache.bypass()
+            
+            stream = self.client.chat.completions.create(
+                model=ANALYSIS_MODEL,
+                messages=messages,
+                stream=True,
+                **self.COMPLETION_SETTINGS
+            )
+            
+            pieces = []
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    pieces.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+            response_cache.put(cache_key, ANALYSIS_MODEL, ''.join(pieces))
+        except Exception as e:
+            yield f"Error performing AI analysis: {str(e)}"
+        finally:
+            if stream is not None:
+                stream.close()
+    
     def quick_summary(self, emails: List[Dict], documents: List[Dict]) -> str:
         """Generate a quick summary of the search results"""
         if not self.enabled:
@@ -145,7 +512,7 @@ class AIAnalyzer:
             )
             
             return response.choices[0].message.content
-            
+        
         except Exception as e:
             return f"Found {len(emails)} emails and {len(documents)} documents."
 
@@ -0,0 +1,205 @@
+import os
+import hashlib
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from database import ParsedContent, ContentBlob, ContentLink
+
+class ContentCache:
+    """Persistent store for extracted document and email text
+    
+    Project documents are stored once per distinct text (SHA-256) in content_blobs and
+    referenced from content_links rows of (project, file_id, modifiedTime); a blob is
+    deleted when its last link goes. Other entries are keyed by (user_id, file_id,
+    modifiedTime) for documents or (user_id, message_id) for emails. Entries and blobs
+    share one LRU bounded by MAX_BYTES; evicting a blob drops its links.
+    Entries are written through the caller's session and saved when the caller commits.
+    """
+    
+    MAX_BYTES = int(os.getenv("CONTENT_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def document_key(user_id: int, file_id: str, modified_time: str) -> str:
+        return f"document:{user_id}:{file_id}:{modified_time or ''}"
+    
+    @staticmethod
+    def email_key(user_id: int, message_id: str) -> str:
+        return f"email:{user_id}:{message_id}"
+    
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+    
+    def get(self, db: Session, cache_key: str) -> Optional[str]:
+        """Return cached content and mark it recently used, or None on a miss"""
+        entry = db.query(ParsedContent).filter(ParsedContent.cache_key == cache_key).first()
+        if entry is None:
+            self._count(False)
+            return None
+        entry.last_accessed = datetime.utcnow()
+        self._count(True)
+        return entry.content
+    
+    def contains(self, db: Session, cache_key: str) -> bool:
+        """Whether content is cached, without counting a hit or miss or refreshing its LRU position"""
+        return db.query(ParsedContent.id).filter(ParsedContent.cache_key == cache_key).first() is not None
+    
+    def put(self, db: Session, cache_key: str, kind: str, source_id: str, content: str):
+        """Store extracted content, then evict least recently used entries over MAX_BYTES"""
+        if not content:
+            return  # Parsers return "" on failure - don't cache errors
+        entry = db.query(ParsedContent).filter(ParsedContent.cache_key == cache_key).first()
+        if entry is None:
+            entry = ParsedContent(cache_key=cache_key, kind=kind, source_id=source_id)
+            db.add(entry)
+        entry.content = content
+        entry.size = len(content.encode('utf-8'))
+        entry.last_accessed = datetime.utcnow()
+        db.flush()
+        self._evict(db)
+    
+    def remove_user_emails(self, db: Session, user_id: int):
+        """Drop a user's cached email bodies (e.g. when they disconnect Google)"""
+        db.query(ParsedContent).filter(
+            ParsedContent.cache_key.like(f"{self.email_key(user_id, '')}%")
+        ).delete(synchronize_session=False)
+    
+    def _evict(self, db: Session):
+        total = (db.query(func.coalesce(func.sum(ParsedContent.size), 0)).scalar()
+                 + db.query(func.coalesce(func.sum(ContentBlob.size), 0)).scalar())
+        if total <= self.MAX_BYTES:
+            return
+        candidates = [
+            (last_accessed, entry_id, None, size)
+            for entry_id, size, last_accessed in db.query(ParsedContent.id, ParsedContent.size, ParsedContent.last_accessed)
+        ] + [
+            (last_accessed, None, digest, size)
+            for digest, size, last_accessed in db.query(ContentBlob.content_hash, ContentBlob.size, ContentBlob.last_accessed)
+        ]
+        candidates.sort(key=lambda candidate: candidate[0] or datetime.min)
+        evict_ids, evict_hashes = [], []
+        for _, entry_id, digest, size in candidates:
+            if total <= self.MAX_BYTES:
+                break
+            total -= size or 0
+            if digest is None:
+                evict_ids.append(entry_id)
+            else:
+                evict_hashes.append(digest)
+        db.query(ParsedContent).filter(ParsedContent.id.in_(evict_ids)).delete(synchronize_session=False)
+        db.query(ContentLink).filter(ContentLink.content_hash.in_(evict_hashes)).delete(synchronize_session=False)
+        db.query(ContentBlob).filter(ContentBlob.content_hash.in_(evict_hashes)).delete(synchronize_session=False)
+        evicted = len(evict_ids) + len(evict_hashes)
+        with self._lock:
+            self.evictions += evicted
+        print(f"Content cache: evicted {evicted} entries to stay under {self.MAX_BYTES} bytes")
+    
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+    
+    def get_document(self, db: Session, project_id: int, file_id: str, revision: str) -> Optional[str]:
+        """Return a document's text if any project already extracted this revision, linking it to project_id"""
+        revision = revision or ''
+        link = db.query(ContentLink).filter(
+            ContentLink.source_id == file_id,
+            ContentLink.revision == revision
+        ).first()
+        blob = link and db.query(ContentBlob).filter(ContentBlob.content_hash == link.content_hash).first()
+        if blob is None:
+            self._count(False)
+            return None
+        blob.last_accessed = datetime.utcnow()
+        self._link(db, project_id, file_id, revision, blob.content_hash)
+        self._count(True)
+        return blob.content
+    
+    def put_document(self, db: Session, project_id: int, file_id: str, revision: str, content: str):
+        """Store a document's text for a project, sharing the blob with any identical text"""
+        if not content:
+            return  # Parsers return "" on failure - don't cache errors
+        digest = self.content_hash(content)
+        # Insert-or-ignore: the pre-parser and an analysis request often store the same document at once
+        db.execute(insert(ContentBlob).values(
+            content_hash=digest, content=content, size=len(content.encode('utf-8')),
+            last_accessed=datetime.utcnow(), created_at=datetime.utcnow()
+        ).on_conflict_do_update(
+            index_elements=[ContentBlob.content_hash], set_={'last_accessed': datetime.utcnow()}
+        ))
+        self._link(db, project_id, file_id, revision or '', digest)
+        self._evict(db)
+    
+    def _link(self, db: Session, project_id: int, file_id: str, revision: str, digest: str):
+        """Point the project's reference to file_id at digest, releasing text of older revisions"""
+        link = db.query(ContentLink).filter(
+            ContentLink.project_id == project_id,
+            ContentLink.source_id == file_id
+        ).first()
+        if link and link.revision == revision and link.content_hash == digest:
+            return
+        # Upsert on (project_id, source_id) in case another session linked the file meanwhile
+        db.execute(insert(ContentLink).values(
+            project_id=project_id, source_id=file_id, revision=revision, content_hash=digest, created_at=datetime.utcnow()
+        ).on_conflict_do_update(
+            index_elements=[ContentLink.project_id, ContentLink.source_id],
+            set_={'revision': revision, 'content_hash': digest}
+        ))
+        if link:
+            old_digest = link.content_hash
+            db.expire(link)
+            if old_digest != digest:
+                self._delete_orphans(db, {old_digest})
+    
+    def release_project(self, db: Session, project_id: int) -> int:
+        """Drop a project's document links and any blobs no other project references; returns blobs deleted"""
+        hashes = {digest for (digest,) in db.query(ContentLink.content_hash).filter(ContentLink.project_id == project_id)}
+        db.query(ContentLink).filter(ContentLink.project_id == project_id).delete(synchronize_session=False)
+        return self._delete_orphans(db, hashes)
+    
+    def _delete_orphans(self, db: Session, hashes: Iterable[str]) -> int:
+        hashes = set(hashes)
+        if not hashes:
+            return 0
+        referenced = {
+            digest for (digest,) in
+            db.query(ContentLink.content_hash).filter(ContentLink.content_hash.in_(hashes)).distinct()
+        }
+        return db.query(ContentBlob).filter(
+            ContentBlob.content_hash.in_(hashes - referenced)
+        ).delete(synchronize_session=False)
+    
+    def get_stats(self, db: Session) -> Dict:
+        entries, total = db.query(
+            func.count(ParsedContent.id), func.coalesce(func.sum(ParsedContent.size), 0)
+        ).one()
+        blobs, blob_bytes = db.query(
+            func.count(ContentBlob.id), func.coalesce(func.sum(ContentBlob.size), 0)
+        ).one()
+        links = db.query(func.count(ContentLink.id)).scalar()
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': entries,
+                'bytes': total,
+                'max_bytes': self.MAX_BYTES,
+                'document_blobs': blobs,
+                'document_blob_bytes': blob_bytes,
+                'document_links': links
+            }
+
+content_cache = ContentCache()
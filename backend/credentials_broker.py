@@ -0,0 +1,111 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+
+from database import SessionLocal, GoogleCredentials
+from google_services import GoogleServicesManager
+
+class CredentialsBroker:
+    """Caches live Google credentials per user and refreshes them ahead of expiry
+    
+    Concurrent requests for the same user share one refresh (single-flight) and the
+    new token is written back to the google_credentials row once.
+    """
+    
+    # Refresh tokens this long before they expire so in-flight requests never see a 401
+    REFRESH_MARGIN = timedelta(minutes=5)
+    
+    def __init__(self):
+        self._credentials: Dict[int, Credentials] = {}
+        self._persisted_tokens: Dict[int, str] = {}
+        self._user_locks: Dict[int, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+    
+    def _user_lock(self, user_id: int) -> threading.Lock:
+        with self._locks_lock:
+            if user_id not in self._user_locks:
+                self._user_locks[user_id] = threading.Lock()
+            return self._user_locks[user_id]
+    
+    def _load(self, user_id: int) -> Optional[Credentials]:
+        """Build Credentials from the user's stored Google tokens"""
+        db = SessionLocal()
+        try:
+            creds = db.query(GoogleCredentials).filter(GoogleCredentials.user_id == user_id).first()
+            if not creds:
+                return None
+            
+            google_manager = GoogleServicesManager()
+            credentials = Credentials(
+                token=creds.access_token,
+                refresh_token=creds.refresh_token,
+                token_uri="https://oauth2.googleapis.com/token",
+                client_id=google_manager.client_id,
+                client_secret=google_manager.client_secret,
+                scopes=json.loads(creds.scopes) if creds.scopes else []
+            )
+            credentials.expiry = creds.token_expiry
+            self._persisted_tokens[user_id] = creds.access_token
+            return credentials
+        finally:
+            db.close()
+    
+    def _persist(self, user_id: int, credentials: Credentials):
+        """Write a refreshed access token back to the database"""
+        db = SessionLocal()
+        try:
+            creds = db.query(GoogleCredentials).filter(GoogleCredentials.user_id == user_id).first()
+            if creds:
+                creds.access_token = credentials.token
+                creds.token_expiry = credentials.expiry
+                creds.updated_at = datetime.utcnow()
+                db.commit()
+            self._persisted_tokens[user_id] = credentials.token
+        except Exception as e:
+            # e.g. SQLite locked by the calling request's open transaction - retried on the next call
+            print(f"Failed to save refreshed Google token for user {user_id}: {e}")
+            db.rollback()
+        finally:
+            db.close()
+    
+    def _needs_refresh(self, credentials: Credentials) -> bool:
+        if not credentials.token:
+            return True
+        if credentials.expiry is None:
+            return False
+        return datetime.utcnow() + self.REFRESH_MARGIN >= credentials.expiry
+    
+    def get_credentials(self, user_id: int) -> Optional[Credentials]:
+        """Return live credentials for a user, or None if Google services are not connected"""
+        with self._user_lock(user_id):
+            credentials = self._credentials.get(user_id)
+            if credentials is None:
+                credentials = self._load(user_id)
+                if credentials is None:
+                    return None
+                self._credentials[user_id] = credentials
+            
+            if self._needs_refresh(credentials) and credentials.refresh_token:
+                try:
+                    print(f"Refreshing Google access token for user {user_id}")
+                    credentials.refresh(Request())
+                except Exception as e:
+                    # Leave the token as is - the Google API call will report the failure
+                    print(f"Failed to refresh Google access token for user {user_id}: {e}")
+            
+            # Persist new tokens, including ones the HTTP transport refreshed on a 401
+            if credentials.token != self._persisted_tokens.get(user_id):
+                self._persist(user_id, credentials)
+            
+            return credentials
+    
+    def invalidate(self, user_id: int):
+        """Drop cached credentials after the user's stored tokens change or are removed"""
+        with self._user_lock(user_id):
+            self._credentials.pop(user_id, None)
+            self._persisted_tokens.pop(user_id, None)
+
+credentials_broker = CredentialsBroker()
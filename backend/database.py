@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, Float, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, Float, ForeignKey, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
@@ -47,6 +47,94 @@ class Project(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class SyncState(Base):
+    __tablename__ = "sync_states"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True)
+    project_id = Column(Integer, index=True)  # NULL for per-user cursors
+    service = Column(String)  # 'gmail' (per-project mailbox historyId) or 'drive' (per-user changes startPageToken)
+    cursor = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ParsedContent(Base):
+    __tablename__ = "parsed_contents"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, unique=True, index=True)  # e.g. "document:<user_id>:<file_id>:<modifiedTime>"
+    kind = Column(String)  # 'document' or 'email'
+    source_id = Column(String, index=True)  # Drive file ID or Gmail message ID
+    content = Column(Text)
+    size = Column(Integer)  # bytes of UTF-8 content
+    last_accessed = Column(DateTime, default=datetime.utcnow, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ContentBlob(Base):
+    __tablename__ = "content_blobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String, unique=True, index=True)  # SHA-256 of the extracted text
+    content = Column(Text)
+    size = Column(Integer)  # bytes of UTF-8 content
+    last_accessed = Column(DateTime, default=datetime.utcnow, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ContentLink(Base):
+    __tablename__ = "content_links"
+    __table_args__ = (UniqueConstraint('project_id', 'source_id'),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, index=True)
+    source_id = Column(String, index=True)  # Drive file ID
+    revision = Column(String)  # Drive modifiedTime the text was extracted from
+    content_hash = Column(String, index=True)  # ContentBlob holding the text
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class IndexChunk(Base):
+    __tablename__ = "index_chunks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, index=True)
+    source_type = Column(String)  # 'email' or 'document'
+    source_id = Column(String, index=True)  # Gmail message ID or Drive file ID
+    chunk_index = Column(Integer)  # 0 = subject/name and snippet, 1+ = body text
+    content = Column(Text)
+    length = Column(Integer)  # number of indexed terms
+    content_hash = Column(String)  # SHA-256 of the body text the chunk came from
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class IndexPosting(Base):
+    __tablename__ = "index_postings"
+
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, index=True)
+    term = Column(String, index=True)
+    chunk_id = Column(Integer, index=True)
+    frequency = Column(Integer)  # occurrences of term in the chunk
+
+class CachedResponse(Base):
+    __tablename__ = "cached_responses"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, unique=True, index=True)  # see ResponseCache.make_key
+    model = Column(String)
+    response = Column(Text)
+    expires_at = Column(DateTime, index=True)
+    last_accessed = Column(DateTime, default=datetime.utcnow, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class CachedSummary(Base):
+    __tablename__ = "cached_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, unique=True, index=True)  # map-reduce batch summaries, see AIAnalyzer.summarize_batch
+    model = Column(String)
+    response = Column(Text)
+    expires_at = Column(DateTime, index=True)
+    last_accessed = Column(DateTime, default=datetime.utcnow, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class Thread(Base):
     __tablename__ = "threads"
 
@@ -1,20 +1,287 @@
 import io
 import os
-from typing import Dict, Optional
+import re
+import time
+import uuid
+import queue
+import base64
+import zipfile
+import xml.etree.ElementTree as ET
+import tempfile
+import threading
+import multiprocessing
+from itertools import chain
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterator, List, Optional
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from google_client import get_service
 from googleapiclient.http import MediaIoBaseDownload
 import PyPDF2
-from docx import Document
+
+# PDF text extraction is CPU-bound and holds the GIL, so it runs in worker processes. Workers are forked
+# from a forkserver, which imports the app once, instead of spawned, which re-imports it in every worker.
+_PDF_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+# Workers report (task_id, time.time()) when they start a page range; drained into _range_starts
+_pdf_started = None
+_range_starts: Dict[str, float] = {}
+_worker_started = None
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool, _pdf_started
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            context = multiprocessing.get_context(_PDF_START_METHOD)
+            _pdf_started = context.Queue()
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=DocumentParser.PDF_MAX_WORKERS,
+                mp_context=context,
+                initializer=_init_pdf_worker,
+                initargs=(_pdf_started,)
+            )
+        return _pdf_pool
+
+def _range_start_time(task_id: str) -> Optional[float]:
+    """When a worker started page range task_id, or None if it has not started"""
+    with _pdf_pool_lock:
+        while _pdf_started is not None:
+            try:
+                started_id, started_at = _pdf_started.get_nowait()
+            except queue.Empty:
+                break
+            _range_starts[started_id] = started_at
+        return _range_starts.get(task_id)
+
+def _reset_pdf_pool(pool: ProcessPoolExecutor, terminate: bool = False):
+    """Stop using pool after a worker crashed (BrokenProcessPool) or hung (terminate kills its workers)
+    
+    Ranges other requests still have running in the pool fail and are marked as not extracted.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    # Snapshot the workers first: shutdown() drops the executor's reference to them
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    if terminate:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+def _init_pdf_worker(started):
+    global _worker_started
+    _worker_started = started
+
+def _extract_pdf_pages(task_id: str, path: str, start: int, end: int) -> List[str]:
+    """Worker: extract text from pages [start, end) of the PDF at path"""
+    _worker_started.put((task_id, time.time()))
+    reader = PyPDF2.PdfReader(path)
+    return [reader.pages[i].extract_text() or '' for i in range(start, end)]
+
+class _HTMLTextExtractor(HTMLParser):
+    """Collect the visible text of an HTML email body, one line per block element"""
+    
+    BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'table'}
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+    
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+    
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+    
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+    
+    def text(self) -> str:
+        lines = (' '.join(line.split()) for line in ''.join(self.parts).splitlines())
+        return '\n'.join(line for line in lines if line)
+
+def html_to_text(html: str) -> str:
+    """Convert an HTML body to plain text"""
+    extractor = _HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.text()
+
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def _docx_parts(archive: zipfile.ZipFile) -> List[str]:
+    """Text-bearing parts of a DOCX in reading order: headers, body, footnotes, footers"""
+    names = archive.namelist()
+    headers = sorted(name for name in names if name.startswith('word/header') and name.endswith('.xml'))
+    footers = sorted(name for name in names if name.startswith('word/footer') and name.endswith('.xml'))
+    body = [name for name in ('word/document.xml', 'word/footnotes.xml') if name in names]
+    return headers + body + footers
+
+def iter_docx_text(file_handle) -> Iterator[str]:
+    """Yield DOCX text one paragraph or table row at a time without building the document tree
+    
+    Runs iterparse over each part inside the zip and drops paragraphs and tables from the
+    tree once their text is read. Table rows are yielded as cell texts joined with ' | '.
+    """
+    with zipfile.ZipFile(file_handle) as archive:
+        for name in _docx_parts(archive):
+            with archive.open(name) as part:
+                paragraph = []
+                # One list of rows per open table, one list of cell texts per open row / cell
+                rows, cells, cell_paragraphs = [], [], []
+                # Open elements, so finished paragraphs and tables can be detached from their parent
+                open_elements = []
+                for event, elem in ET.iterparse(part, events=('start', 'end')):
+                    tag = elem.tag
+                    if event == 'start':
+                        open_elements.append(elem)
+                        if tag == f'{_W}tr':
+                            rows.append([])
+                        elif tag == f'{_W}tc':
+                            cell_paragraphs.append([])
+                        continue
+                    
+                    open_elements.pop()
+                    if tag == f'{_W}t':
+                        paragraph.append(elem.text or '')
+                    elif tag == f'{_W}tab' and open_elements and open_elements[-1].tag == f'{_W}r':
+                        # Only run content; w:pPr/w:tabs also holds w:tab tab-stop definitions
+                        paragraph.append('\t')
+                    elif tag in (f'{_W}br', f'{_W}cr'):
+                        paragraph.append('\n')
+                    elif tag == f'{_W}p':
+                        text = ''.join(paragraph)
+                        paragraph = []
+                        if cell_paragraphs:
+                            cell_paragraphs[-1].append(text)
+                        elif text:
+                            yield text
+                    elif tag == f'{_W}tc':
+                        cell = ' '.join(text for text in cell_paragraphs.pop() if text)
+                        if rows:
+                            rows[-1].append(cell)
+                    elif tag == f'{_W}tr':
+                        row = rows.pop()
+                        line = ' | '.join(row)
+                        if cell_paragraphs:
+                            # Nested table: the row becomes text of the enclosing cell
+                            cell_paragraphs[-1].append(line)
+                        elif any(row):
+                            yield line
+                    
+                    if tag in (f'{_W}p', f'{_W}tc', f'{_W}tr', f'{_W}tbl') and open_elements:
+                        open_elements[-1].remove(elem)
+
+class DownloadTooLargeError(Exception):
+    """Raised when a Drive download exceeds DocumentParser.DOWNLOAD_MAX_BYTES"""
+
+class SpooledDownload:
+    """Write target for MediaIoBaseDownload that keeps small files in memory and spools large ones to disk
+    
+    Content moves to a named temporary file once it grows past spool_bytes, and
+    writing more than max_bytes raises DownloadTooLargeError. Use as a context
+    manager so the temporary file is always removed.
+    """
+    
+    def __init__(self, spool_bytes: int, max_bytes: int, suffix: str = ''):
+        self.spool_bytes = spool_bytes
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.size = 0
+        self.path = None
+        self._buffer = io.BytesIO()
+        self._file = None
+    
+    def write(self, data: bytes) -> int:
+        if self.size + len(data) > self.max_bytes:
+            raise DownloadTooLargeError(f"Download exceeds {self.max_bytes} bytes")
+        if self._file is None and self.size + len(data) > self.spool_bytes:
+            self.rollover()
+        (self._file or self._buffer).write(data)
+        self.size += len(data)
+        return len(data)
+    
+    def rollover(self) -> str:
+        """Move the content to a temporary file on disk (if not already there) and return its path"""
+        if self._file is None:
+            self._file = tempfile.NamedTemporaryFile(suffix=self.suffix, delete=False)
+            self.path = self._file.name
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+        self._file.flush()
+        return self.path
+    
+    def open(self):
+        """Readable, seekable view of the content: the in-memory buffer, or a read-only handle on the spooled file"""
+        if self._file is None:
+            self._buffer.seek(0)
+            return self._buffer
+        return open(self.rollover(), 'rb')
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            os.remove(self.path)
+            self._file = None
+        self._buffer = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 class DocumentParser:
     """Parse content from various document types"""
     
+    # Drive binary downloads: bytes per HTTP request (each chunk is held in memory while it is
+    # written out), size above which a download is spooled to disk, and hard size limit
+    DOWNLOAD_CHUNK_BYTES = int(os.getenv("DRIVE_DOWNLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+    DOWNLOAD_SPOOL_BYTES = int(os.getenv("DRIVE_DOWNLOAD_SPOOL_BYTES", str(4 * 1024 * 1024)))
+    DOWNLOAD_MAX_BYTES = int(os.getenv("DRIVE_DOWNLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+    # Text kept from a DOCX file; parsing stops once it is reached
+    DOCX_MAX_CHARS = int(os.getenv("DOCX_MAX_CHARS", "100000"))
+    # Cells read per sheet and total text kept from a spreadsheet
+    SHEETS_MAX_ROWS = int(os.getenv("SHEETS_MAX_ROWS", "1000"))
+    SHEETS_MAX_COLUMNS = int(os.getenv("SHEETS_MAX_COLUMNS", "26"))
+    SHEETS_MAX_CHARS = int(os.getenv("SHEETS_MAX_CHARS", "100000"))
+    # Read Google Docs and Slides through Drive's plain text export, falling back to the Docs/Slides APIs
+    EXPORT_TEXT = os.getenv("GOOGLE_EXPORT_TEXT", "true").lower() == "true"
+    
+    PDF_MAX_WORKERS = int(os.getenv("PDF_MAX_WORKERS", str(os.cpu_count() or 2)))
+    # Pages per worker task; PDFs with more pages are split across workers
+    PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "25"))
+    PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "500"))
+    PDF_TIMEOUT_SECONDS = float(os.getenv("PDF_TIMEOUT_SECONDS", "60"))
+    
     @staticmethod
     def parse_google_doc(credentials: Credentials, file_id: str) -> str:
         """Extract text from Google Docs"""
+        if DocumentParser.EXPORT_TEXT:
+            try:
+                return DocumentParser.export_text(credentials, file_id)
+            except Exception as e:
+                print(f"Plain text export failed for Google Doc {file_id}, reading document structure: {e}")
+        return DocumentParser.parse_google_doc_structure(credentials, file_id)
+    
+    @staticmethod
+    def parse_google_doc_structure(credentials: Credentials, file_id: str) -> str:
+        """Extract text from Google Docs by walking the Docs API document body"""
         try:
-            service = build('docs', 'v1', credentials=credentials)
+            service = get_service('docs', 'v1', credentials)
             document = service.documents().get(documentId=file_id).execute()
             
             content = []
@@ -31,82 +298,203 @@ class DocumentParser:
             return ""
     
     @staticmethod
-    def parse_pdf(credentials: Credentials, file_id: str) -> str:
-        """Extract text from PDF files"""
+    def extract_pdf_text(path: str) -> str:
+        """Extract PDF text in a process pool, splitting large files into page ranges across workers
+        
+        At most PDF_MAX_PAGES pages are read; text is returned in page order. Ranges still queued
+        behind other PDFs after PDF_TIMEOUT_SECONDS are cancelled, and a range running longer than
+        PDF_TIMEOUT_SECONDS is treated as hung: the pool is killed and replaced. Both get a marker.
+        """
+        page_count = len(PyPDF2.PdfReader(path).pages)
+        pages_to_read = min(page_count, DocumentParser.PDF_MAX_PAGES)
+        
+        ranges = [
+            (start, min(start + DocumentParser.PDF_PAGES_PER_TASK, pages_to_read))
+            for start in range(0, pages_to_read, DocumentParser.PDF_PAGES_PER_TASK)
+        ]
+        pool = _get_pdf_pool()
+        task_ids = [uuid.uuid4().hex for _ in ranges]
+        futures = [
+            pool.submit(_extract_pdf_pages, task_id, path, start, end)
+            for task_id, (start, end) in zip(task_ids, ranges)
+        ]
+        
+        wait(futures, timeout=DocumentParser.PDF_TIMEOUT_SECONDS)
+        
+        # The deadline applies to each range from when a worker started it, not from submission
+        hung = False
+        for task_id, future in zip(task_ids, futures):
+            if hung:
+                future.cancel()  # The pool is about to be killed
+                continue
+            while not future.done():
+                started_at = _range_start_time(task_id)
+                if started_at is None:
+                    if future.cancel():
+                        break  # Still queued behind other PDFs
+                    wait([future], timeout=1)  # Handed to a worker, about to start
+                    continue
+                remaining = started_at + DocumentParser.PDF_TIMEOUT_SECONDS - time.time()
+                if remaining <= 0:
+                    hung = True
+                    break
+                wait([future], timeout=remaining)
+        
+        with _pdf_pool_lock:
+            for task_id in task_ids:
+                _range_starts.pop(task_id, None)
+        
+        text = []
+        pool_broken = False
+        for (start, end), future in zip(ranges, futures):
+            if future.cancelled():
+                reason = 'not started in time'
+            elif not future.done():
+                reason = 'timed out'
+            elif future.exception():
+                reason = f'failed: {future.exception()}'
+                pool_broken = pool_broken or isinstance(future.exception(), BrokenProcessPool)
+            else:
+                text.extend(future.result())
+                continue
+            print(f"PDF pages {start + 1}-{end} {reason}")
+            text.append(f"[Pages {start + 1}-{end} could not be extracted ({reason})]")
+        
+        if hung or pool_broken:
+            # A worker stuck in PyPDF2 never finishes, so kill the pool rather than let hung workers pile up
+            _reset_pdf_pool(pool, terminate=hung)
+        
+        if page_count > pages_to_read:
+            text.append(f"[Truncated: extracted {pages_to_read} of {page_count} pages]")
+        
+        return '\n'.join(text)
+    
+    @staticmethod
+    def _download(request, suffix: str = '') -> SpooledDownload:
+        """Stream a Drive media request into a SpooledDownload in DOWNLOAD_CHUNK_BYTES chunks
+        
+        Raises DownloadTooLargeError as soon as the content is known to exceed DOWNLOAD_MAX_BYTES.
+        """
+        download = SpooledDownload(DocumentParser.DOWNLOAD_SPOOL_BYTES, DocumentParser.DOWNLOAD_MAX_BYTES, suffix)
         try:
-            service = build('drive', 'v3', credentials=credentials)
-            request = service.files().get_media(fileId=file_id)
-            
-            file_handle = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_handle, request)
+            downloader = MediaIoBaseDownload(download, request, chunksize=DocumentParser.DOWNLOAD_CHUNK_BYTES)
             
             done = False
             while not done:
                 status, done = downloader.next_chunk()
-            
-            file_handle.seek(0)
-            pdf_reader = PyPDF2.PdfReader(file_handle)
-            
-            text = []
-            for page in pdf_reader.pages:
-                text.append(page.extract_text())
-            
-            return '\n'.join(text)
+                # The first response reports the full size; stop before fetching the rest of an oversized file
+                if status.total_size and status.total_size > DocumentParser.DOWNLOAD_MAX_BYTES:
+                    raise DownloadTooLargeError(
+                        f"File is {status.total_size} bytes, limit is {DocumentParser.DOWNLOAD_MAX_BYTES}"
+                    )
+            return download
+        except Exception:
+            download.close()
+            raise
+    
+    @staticmethod
+    def download_file(credentials: Credentials, file_id: str, suffix: str = '') -> SpooledDownload:
+        """Download a binary Drive file (see _download)"""
+        service = get_service('drive', 'v3', credentials)
+        return DocumentParser._download(service.files().get_media(fileId=file_id), suffix)
+    
+    @staticmethod
+    def export_text(credentials: Credentials, file_id: str) -> str:
+        """Export a Google Docs/Slides file as plain text through Drive files.export"""
+        service = get_service('drive', 'v3', credentials)
+        request = service.files().export_media(fileId=file_id, mimeType='text/plain')
+        with DocumentParser._download(request) as download:
+            with download.open() as file_handle:
+                # Exports start with a UTF-8 byte order mark
+                return file_handle.read().decode('utf-8-sig')
+    
+    @staticmethod
+    def parse_pdf(credentials: Credentials, file_id: str) -> str:
+        """Extract text from PDF files"""
+        try:
+            with DocumentParser.download_file(credentials, file_id, suffix='.pdf') as download:
+                # Worker processes open the PDF by path
+                return DocumentParser.extract_pdf_text(download.rollover())
         except Exception as e:
             print(f"Error parsing PDF: {e}")
             return ""
     
     @staticmethod
     def parse_docx(credentials: Credentials, file_id: str) -> str:
-        """Extract text from DOCX files"""
+        """Extract text from DOCX files, including tables, headers and footers, up to DOCX_MAX_CHARS"""
         try:
-            service = build('drive', 'v3', credentials=credentials)
-            request = service.files().get_media(fileId=file_id)
-            
-            file_handle = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_handle, request)
-            
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            
-            file_handle.seek(0)
-            doc = Document(file_handle)
-            
             text = []
-            for paragraph in doc.paragraphs:
-                text.append(paragraph.text)
+            chars = 0
+            with DocumentParser.download_file(credentials, file_id, suffix='.docx') as download:
+                with download.open() as file_handle:
+                    for line in iter_docx_text(file_handle):
+                        if chars + len(line) > DocumentParser.DOCX_MAX_CHARS:
+                            text.append(line[:DocumentParser.DOCX_MAX_CHARS - chars])
+                            text.append(f"[Truncated at {DocumentParser.DOCX_MAX_CHARS} characters]")
+                            break
+                        text.append(line)
+                        chars += len(line) + 1
             
             return '\n'.join(text)
         except Exception as e:
             print(f"Error parsing DOCX: {e}")
             return ""
     
+    @staticmethod
+    def _column_letter(index: int) -> str:
+        """A1 column name for a 1-based column index (1 -> A, 27 -> AA)"""
+        letters = ''
+        while index > 0:
+            index, remainder = divmod(index - 1, 26)
+            letters = chr(ord('A') + remainder) + letters
+        return letters
+    
     @staticmethod
     def parse_spreadsheet(credentials: Credentials, file_id: str) -> str:
-        """Extract text from Google Sheets"""
+        """Extract text from Google Sheets
+        
+        Reads the first SHEETS_MAX_ROWS x SHEETS_MAX_COLUMNS cells of every sheet in one
+        values.batchGet call and stops once SHEETS_MAX_CHARS characters are collected.
+        """
         try:
-            service = build('sheets', 'v4', credentials=credentials)
+            service = get_service('sheets', 'v4', credentials)
             
-            # Get sheet metadata to find all sheets
-            spreadsheet = service.spreadsheets().get(spreadsheetId=file_id).execute()
-            sheets = spreadsheet.get('sheets', [])
+            # Get sheet titles only
+            spreadsheet = service.spreadsheets().get(
+                spreadsheetId=file_id,
+                fields='sheets/properties/title'
+            ).execute()
+            titles = [sheet['properties']['title'] for sheet in spreadsheet.get('sheets', [])]
+            if not titles:
+                return ""
+            
+            last_column = DocumentParser._column_letter(DocumentParser.SHEETS_MAX_COLUMNS)
+            ranges = [
+                "'{}'!A1:{}{}".format(title.replace("'", "''"), last_column, DocumentParser.SHEETS_MAX_ROWS)
+                for title in titles
+            ]
+            result = service.spreadsheets().values().batchGet(
+                spreadsheetId=file_id,
+                ranges=ranges,
+                valueRenderOption='FORMATTED_VALUE',
+                majorDimension='ROWS'
+            ).execute()
             
             all_data = []
-            for sheet in sheets:
-                sheet_title = sheet['properties']['title']
-                range_name = f"{sheet_title}"
+            chars = 0
+            for title, value_range in zip(titles, result.get('valueRanges', [])):
+                values = value_range.get('values', [])
+                if not values:
+                    continue
                 
-                result = service.spreadsheets().values().get(
-                    spreadsheetId=file_id,
-                    range=range_name
-                ).execute()
-                
-                values = result.get('values', [])
-                if values:
-                    all_data.append(f"Sheet: {sheet_title}")
-                    for row in values:
-                        all_data.append(' | '.join(str(cell) for cell in row))
+                rows = (' | '.join(str(cell) for cell in row) for row in values)
+                for line in chain([f"Sheet: {title}"], rows):
+                    if chars + len(line) > DocumentParser.SHEETS_MAX_CHARS:
+                        all_data.append(line[:DocumentParser.SHEETS_MAX_CHARS - chars])
+                        all_data.append(f"[Truncated at {DocumentParser.SHEETS_MAX_CHARS} characters]")
+                        return '\n'.join(all_data)
+                    all_data.append(line)
+                    chars += len(line) + 1
             
             return '\n'.join(all_data)
         except Exception as e:
@@ -116,8 +504,18 @@ class DocumentParser:
     @staticmethod
     def parse_presentation(credentials: Credentials, file_id: str) -> str:
         """Extract text from Google Slides"""
+        if DocumentParser.EXPORT_TEXT:
+            try:
+                return DocumentParser.export_text(credentials, file_id)
+            except Exception as e:
+                print(f"Plain text export failed for presentation {file_id}, reading slide structure: {e}")
+        return DocumentParser.parse_presentation_structure(credentials, file_id)
+    
+    @staticmethod
+    def parse_presentation_structure(credentials: Credentials, file_id: str) -> str:
+        """Extract text from Google Slides by walking the Slides API page elements"""
         try:
-            service = build('slides', 'v1', credentials=credentials)
+            service = get_service('slides', 'v1', credentials)
             presentation = service.presentations().get(presentationId=file_id).execute()
             
             slides = presentation.get('slides', [])
@@ -154,35 +552,69 @@ class DocumentParser:
         else:
             return f"[Unsupported file type: {mime_type}]"
     
+    @staticmethod
+    def _decode_email_part(part: Dict) -> str:
+        """Decode the base64url body of one MIME part using its declared charset"""
+        data = part.get('body', {}).get('data', '')
+        if not data:
+            return ""
+        charset = 'utf-8'
+        for header in part.get('headers', []):
+            if header.get('name', '').lower() == 'content-type':
+                match = re.search(r'charset="?([\w.:-]+)', header.get('value', ''), re.IGNORECASE)
+                if match:
+                    charset = match.group(1)
+        raw = base64.urlsafe_b64decode(data)
+        try:
+            return raw.decode(charset, errors='replace')
+        except LookupError:
+            return raw.decode('utf-8', errors='replace')
+    
+    @staticmethod
+    def extract_email_body(payload: Dict) -> str:
+        """Text body of a Gmail message payload
+        
+        Walks the whole MIME tree and returns the first non-empty text/plain part,
+        falling back to the first text/html part converted to text. Attachments are skipped.
+        """
+        html = []
+        
+        def find_plain(part: Dict) -> str:
+            if part.get('filename'):
+                return ""
+            mime_type = part.get('mimeType', '')
+            if mime_type == 'text/plain':
+                return DocumentParser._decode_email_part(part)
+            if mime_type == 'text/html':
+                html.append(part)
+                return ""
+            for child in part.get('parts', []):
+                text = find_plain(child)
+                if text.strip():
+                    return text
+            return ""
+        
+        body = find_plain(payload)
+        if body.strip():
+            return body
+        for part in html:
+            text = html_to_text(DocumentParser._decode_email_part(part))
+            if text:
+                return text
+        return ""
+    
     @staticmethod
     def get_email_body(credentials: Credentials, message_id: str) -> str:
         """Extract full body from email"""
         try:
-            service = build('gmail', 'v1', credentials=credentials)
+            service = get_service('gmail', 'v1', credentials)
             message = service.users().messages().get(
                 userId='me',
                 id=message_id,
                 format='full'
             ).execute()
             
-            payload = message.get('payload', {})
-            body = ""
-            
-            if 'parts' in payload:
-                for part in payload['parts']:
-                    if part['mimeType'] == 'text/plain':
-                        data = part['body'].get('data', '')
-                        if data:
-                            import base64
-                            body = base64.urlsafe_b64decode(data).decode('utf-8')
-                            break
-            elif 'body' in payload:
-                data = payload['body'].get('data', '')
-                if data:
-                    import base64
-                    body = base64.urlsafe_b64decode(data).decode('utf-8')
-            
-            return body
+            return DocumentParser.extract_email_body(message.get('payload', {}))
         except Exception as e:
             print(f"Error getting email body: {e}")
             return ""
@@ -0,0 +1,47 @@
+import json
+import threading
+import httplib2
+import google_auth_httplib2
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+
+from rate_limiter import RateLimitedHttp
+
+# Static discovery documents shipped with google-api-python-client, keyed by (api, version)
+_discovery_documents = {}
+_discovery_documents_lock = threading.Lock()
+
+# Per-thread parsed documents and HTTP connection pool. build_from_document annotates the
+# parsed document in place and httplib2.Http is not thread-safe, so neither is shared across threads.
+_thread_state = threading.local()
+
+def _get_discovery_document(api: str, version: str) -> str:
+    """Load the static discovery document for an API once per process"""
+    key = (api, version)
+    with _discovery_documents_lock:
+        if key not in _discovery_documents:
+            document = discovery_cache.get_static_doc(api, version)
+            if document is None:
+                raise ValueError(f"No static discovery document for {api} {version}")
+            _discovery_documents[key] = document
+        return _discovery_documents[key]
+
+def get_service(api: str, version: str, credentials: Credentials):
+    """Return a Google API client for api/version bound to the given user's credentials
+    
+    Replacement for googleapiclient.discovery.build(): the discovery document is loaded
+    once per process and parsed once per thread, and the client reuses this thread's
+    HTTP connections. Requests go through the user's rate limiter (see rate_limiter.py).
+    Use the returned client on the thread that created it.
+    """
+    if not hasattr(_thread_state, 'documents'):
+        _thread_state.documents = {}
+        _thread_state.http = httplib2.Http()
+    
+    key = (api, version)
+    if key not in _thread_state.documents:
+        _thread_state.documents[key] = json.loads(_get_discovery_document(api, version))
+    
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=_thread_state.http)
+    return build_from_document(_thread_state.documents[key], http=RateLimitedHttp(http, api, credentials))
@@ -1,12 +1,24 @@
 import os
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-from typing import List, Dict
+from google_client import get_service
+from document_parser import DocumentParser
+from rate_limiter import is_rate_limited, retry_delay, MAX_RETRIES
+from googleapiclient.errors import HttpError
+from typing import List, Dict, Iterator, Optional
+from datetime import datetime, timezone
 import base64
 from email.utils import parsedate_to_datetime
 from email.mime.text import MIMEText
 
+# Drive query threads shared by all searches. They live for the process so each keeps its parsed
+# discovery documents and HTTP connections (get_service caches both per thread)
+DRIVE_QUERY_WORKERS = int(os.getenv("DRIVE_QUERY_WORKERS", "8"))
+_drive_query_executor = ThreadPoolExecutor(max_workers=DRIVE_QUERY_WORKERS, thread_name_prefix="drive-query")
+
 class GoogleServicesManager:
     """Manages Google API interactions for Gmail and Drive"""
     
@@ -19,12 +31,35 @@ class GoogleServicesManager:
         'https://www.googleapis.com/auth/presentations.readonly'
     ]
     
+    # Gmail allows at most 100 sub-requests per batch HTTP request
+    GMAIL_BATCH_SIZE = 100
+    
+    # Header-only fetch: search results only need these headers, the snippet and labels.
+    # Full bodies are fetched separately by DocumentParser.get_email_body when needed.
+    GMAIL_METADATA_HEADERS = ['Subject', 'From', 'Date']
+    GMAIL_METADATA_FIELDS = 'id,threadId,snippet,labelIds,payload/headers'
+    
+    # Upper bound on messages returned per address when following nextPageToken
+    GMAIL_SEARCH_CAP = int(os.getenv("GMAIL_SEARCH_CAP", "1000"))
+    
+    # Drive files().list accepts up to 1000 files per page
+    DRIVE_PAGE_SIZE = 1000
+    # Upper bound on files returned per Drive query when following nextPageToken
+    DRIVE_SEARCH_CAP = int(os.getenv("DRIVE_SEARCH_CAP", "5000"))
+    # Upper bound on files read from the shared-with-me listing. Drive cannot filter it by sharer,
+    # so it is listed once per project search and matched against every address client-side
+    DRIVE_SHARED_SEARCH_CAP = int(os.getenv("DRIVE_SHARED_SEARCH_CAP", "1000"))
+    DRIVE_FILE_FIELDS = "id, name, mimeType, modifiedTime, webViewLink, owners, sharingUser, shared"
+    
     def __init__(self):
         # You need to create a Google Cloud project and download OAuth credentials
         # For now, we'll use placeholders - replace with your actual credentials
         self.client_id = os.getenv("GOOGLE_CLIENT_ID", "YOUR_GOOGLE_CLIENT_ID")
         self.client_secret = os.getenv("GOOGLE_CLIENT_SECRET", "YOUR_GOOGLE_CLIENT_SECRET")
         self.redirect_uri = "http://localhost:5175/configuration/callback"
+        # HTTP round-trips per API made through this manager (e.g. {'gmail': 2})
+        self.round_trips = {}
+        self._round_trips_lock = threading.Lock()
     
     def get_authorization_url(self) -> str:
         """Generate Google OAuth authorization URL"""
@@ -73,209 +108,545 @@ class GoogleServicesManager:
         flow.fetch_token(code=code)
         return flow.credentials
     
-    def search_emails(self, credentials: Credentials, person: str, date_from: str = None, date_to: str = None) -> List[Dict]:
-        """Search emails from a specific person with date filtering - searches ALL folders including Updates"""
-        try:
-            print(f"\n=== Starting Gmail Search ===")
-            print(f"Searching for emails from: {person}")
-            print(f"Date range: {date_from} to {date_to}")
-            
-            service = build('gmail', 'v1', credentials=credentials)
-            
-            # Build query with date filters
-            # Note: Gmail API searches ALL folders by default (Primary, Social, Updates, Promotions, etc.)
-            query = f'from:{person}'
-            if date_from:
-                query += f' after:{date_from}'
-            if date_to:
-                query += f' before:{date_to}'
-            
-            print(f"Gmail query: {query}")
-            print(f"Note: Searching across ALL Gmail folders (Primary, Updates, Social, Promotions, etc.)")
+    def _record_round_trip(self, api: str, count: int = 1):
+        """Count HTTP round-trips made to a Google API by this manager"""
+        with self._round_trips_lock:
+            self.round_trips[api] = self.round_trips.get(api, 0) + count
+    
+    def _parse_email_message(self, message: Dict) -> Dict:
+        """Convert a Gmail message resource into our email result dict"""
+        headers = message.get('payload', {}).get('headers', [])
+        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
+        from_email = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
+        date = next((h['value'] for h in headers if h['name'] == 'Date'), 'Unknown')
+        
+        snippet = message.get('snippet', '')
+        
+        # Get labels to determine folder
+        labels = message.get('labelIds', [])
+        folder = 'Unknown'
+        if 'CATEGORY_PERSONAL' in labels or 'INBOX' in labels:
+            folder = 'Primary'
+        if 'CATEGORY_UPDATES' in labels:
+            folder = 'Updates'
+        if 'CATEGORY_SOCIAL' in labels:
+            folder = 'Social'
+        if 'CATEGORY_PROMOTIONS' in labels:
+            folder = 'Promotions'
+        if 'CATEGORY_FORUMS' in labels:
+            folder = 'Forums'
+        
+        # Check if this is a Drive sharing notification
+        is_drive_share = 'shared' in subject.lower() and 'drive' in subject.lower()
+        
+        return {
+            'id': message['id'],
+            'subject': subject,
+            'from_': from_email,
+            'date': date,
+            'snippet': snippet,
+            'folder': folder,
+            'is_drive_share': is_drive_share
+        }
+    
+    def _message_get_request(self, service, message_id: str, metadata_only: bool = True):
+        """Build a messages().get request, header-only with a partial-response mask unless full payloads are needed"""
+        if metadata_only:
+            return service.users().messages().get(
+                userId='me',
+                id=message_id,
+                format='metadata',
+                metadataHeaders=self.GMAIL_METADATA_HEADERS,
+                fields=self.GMAIL_METADATA_FIELDS
+            )
+        return service.users().messages().get(userId='me', id=message_id, format='full')
+    
+    def _batch_get_messages(self, service, message_ids: List[str], metadata_only: bool = True, parse=None) -> List:
+        """Fetch messages with Gmail batch requests (one HTTP round-trip per GMAIL_BATCH_SIZE ids)
+        
+        Each response is passed through parse (default: _parse_email_message).
+        """
+        parse = parse or self._parse_email_message
+        fetched = {}
+        rate_limited = []
+        
+        def on_message(request_id, response, exception):
+            # Per-message error path: a single bad message must not fail the whole page
+            if exception is not None:
+                status = getattr(getattr(exception, 'resp', None), 'status', 0)
+                if is_rate_limited(status, getattr(exception, 'content', None)):
+                    rate_limited.append(request_id)
+                    return
+                print(f"  ✗ Failed to fetch message {request_id}: {exception}")
+                return
+            fetched[request_id] = parse(response)
+        
+        pending = list(message_ids)
+        for attempt in range(MAX_RETRIES + 1):
+            for start in range(0, len(pending), self.GMAIL_BATCH_SIZE):
+                chunk = pending[start:start + self.GMAIL_BATCH_SIZE]
+                batch = service.new_batch_http_request(callback=on_message)
+                for message_id in chunk:
+                    batch.add(
+                        self._message_get_request(service, message_id, metadata_only),
+                        request_id=message_id
+                    )
+                batch.execute()
+                self._record_round_trip('gmail')
             
+            if not rate_limited:
+                break
+            # Sub-requests can be rate limited individually inside a successful batch - retry just those
+            pending, rate_limited[:] = list(rate_limited), []
+            if attempt == MAX_RETRIES:
+                print(f"  ✗ Gave up on {len(pending)} rate-limited messages")
+                break
+            delay = retry_delay(attempt)
+            print(f"  {len(pending)} messages were rate limited, retrying in {delay:.1f}s")
+            time.sleep(delay)
+        
+        # Keep the order returned by messages().list (newest first)
+        return [fetched[message_id] for message_id in message_ids if message_id in fetched]
+    
+    def get_email_bodies(self, credentials: Credentials, message_ids: List[str]) -> Dict[str, str]:
+        """Fetch the text bodies of any number of messages with Gmail batch requests, keyed by message id
+        
+        Messages that fail to fetch are left out; messages without a text body map to "".
+        """
+        if not message_ids:
+            return {}
+        try:
+            service = get_service('gmail', 'v1', credentials)
+            bodies = self._batch_get_messages(
+                service,
+                list(dict.fromkeys(message_ids)),
+                metadata_only=False,
+                parse=lambda message: (message['id'], DocumentParser.extract_email_body(message.get('payload', {})))
+            )
+            return dict(bodies)
+        except Exception as e:
+            print(f"Error getting email bodies: {e}")
+            return {}
+    
+    @staticmethod
+    def combine_senders(persons: List[str]) -> str:
+        """Merge several addresses into one Gmail sender expression, e.g. (a OR b) for from:(a OR b)"""
+        return f"({' OR '.join(persons)})"
+    
+    def _build_gmail_query(self, person: str, date_from: str = None, date_to: str = None) -> str:
+        """Build a Gmail search query with date filters"""
+        # Note: Gmail API searches ALL folders by default (Primary, Social, Updates, Promotions, etc.)
+        query = f'from:{person}'
+        if date_from:
+            query += f' after:{date_from}'
+        if date_to:
+            query += f' before:{date_to}'
+        return query
+    
+    def iter_emails(self, credentials: Credentials, person: str, date_from: str = None, date_to: str = None,
+                    chunk_size: int = None, max_results: int = None,
+                    metadata_only: bool = True) -> Iterator[List[Dict]]:
+        """Yield emails from a specific person in chunks, following every nextPageToken
+        
+        Each chunk is one messages().list page (at most chunk_size ids) fetched with a
+        single batch request, so memory stays bounded by chunk_size regardless of how
+        many messages match. Stops after max_results messages (GMAIL_SEARCH_CAP by default).
+        """
+        chunk_size = min(chunk_size or self.GMAIL_BATCH_SIZE, self.GMAIL_BATCH_SIZE)
+        max_results = max_results if max_results is not None else self.GMAIL_SEARCH_CAP
+        
+        service = get_service('gmail', 'v1', credentials)
+        query = self._build_gmail_query(person, date_from, date_to)
+        print(f"Gmail query: {query} (chunk size {chunk_size}, cap {max_results})")
+        
+        page_token = None
+        listed = 0
+        while listed < max_results:
             results = service.users().messages().list(
                 userId='me',
                 q=query,
-                maxResults=100
+                maxResults=min(chunk_size, max_results - listed),
+                pageToken=page_token
             ).execute()
+            self._record_round_trip('gmail')
             
-            messages = results.get('messages', [])
-            print(f"Found {len(messages)} email messages across all folders")
-            emails = []
+            message_ids = [msg['id'] for msg in results.get('messages', [])]
+            listed += len(message_ids)
             
-            folder_counts = {}
+            chunk = self._batch_get_messages(service, message_ids, metadata_only)
+            if chunk:
+                yield chunk
             
-            for msg in messages:
-                message = service.users().messages().get(
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        
+        if page_token:
+            print(f"Gmail search for {person} stopped at cap of {max_results} messages")
+    
+    def get_history_id(self, credentials: Credentials) -> str:
+        """Return the mailbox's current historyId (the starting point for the next incremental sync)"""
+        service = get_service('gmail', 'v1', credentials)
+        profile = service.users().getProfile(userId='me', fields='historyId').execute()
+        self._record_round_trip('gmail')
+        return profile.get('historyId')
+    
+    def _email_matches(self, email: Dict, persons: List[str], date_from: datetime = None, date_to: datetime = None) -> bool:
+        """Check an email against the project's from:/after:/before: filters"""
+        sender = email.get('from_', '').lower()
+        if not any(person.lower() in sender for person in persons):
+            return False
+        if date_from or date_to:
+            try:
+                sent_at = parsedate_to_datetime(email.get('date', ''))
+                if sent_at.tzinfo:
+                    sent_at = sent_at.astimezone(timezone.utc).replace(tzinfo=None)
+            except Exception:
+                return True  # Can't parse the date - keep it rather than silently drop it
+            if date_from and sent_at < date_from:
+                return False
+            if date_to and sent_at >= date_to:
+                return False
+        return True
+    
+    def sync_emails(self, credentials: Credentials, start_history_id: str, persons: List[str],
+                    date_from: datetime = None, date_to: datetime = None) -> Optional[Dict]:
+        """Fetch only the mailbox changes since start_history_id using users.history.list
+        
+        Returns {'added': [email dicts matching the filters], 'deleted': [message ids],
+        'history_id': new cursor}, or None when start_history_id is too old and a full
+        search is required.
+        """
+        print(f"\n=== Starting Incremental Gmail Sync from historyId {start_history_id} ===")
+        service = get_service('gmail', 'v1', credentials)
+        
+        added_ids = []
+        deleted_ids = set()
+        history_id = start_history_id
+        page_token = None
+        try:
+            while True:
+                results = service.users().history().list(
                     userId='me',
-                    id=msg['id'],
-                    format='full'
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded', 'messageDeleted'],
+                    maxResults=500,
+                    pageToken=page_token
                 ).execute()
+                self._record_round_trip('gmail')
                 
-                headers = message['payload']['headers']
-                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-                from_email = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
-                date = next((h['value'] for h in headers if h['name'] == 'Date'), 'Unknown')
-                
-                snippet = message.get('snippet', '')
-                
-                # Get labels to determine folder
-                labels = message.get('labelIds', [])
-                folder = 'Unknown'
-                if 'CATEGORY_PERSONAL' in labels or 'INBOX' in labels:
-                    folder = 'Primary'
-                if 'CATEGORY_UPDATES' in labels:
-                    folder = 'Updates'
-                if 'CATEGORY_SOCIAL' in labels:
-                    folder = 'Social'
-                if 'CATEGORY_PROMOTIONS' in labels:
-                    folder = 'Promotions'
-                if 'CATEGORY_FORUMS' in labels:
-                    folder = 'Forums'
+                for record in results.get('history', []):
+                    for item in record.get('messagesAdded', []):
+                        added_ids.append(item['message']['id'])
+                    for item in record.get('messagesDeleted', []):
+                        deleted_ids.add(item['message']['id'])
                 
+                history_id = results.get('historyId', history_id)
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+        except HttpError as e:
+            if e.resp.status == 404:
+                print(f"historyId {start_history_id} has expired - a full search is required")
+                return None
+            raise
+        
+        # Messages added and then deleted within the window don't need fetching
+        added_ids = [message_id for message_id in dict.fromkeys(added_ids) if message_id not in deleted_ids]
+        fetched = self._batch_get_messages(service, added_ids)
+        added = [email for email in fetched if self._email_matches(email, persons, date_from, date_to)]
+        
+        print(f"History: {len(added_ids)} added ({len(added)} matching), {len(deleted_ids)} deleted")
+        print(f"=== Incremental Gmail Sync Complete: now at historyId {history_id} ===\n")
+        return {
+            'added': added,
+            'deleted': list(deleted_ids),
+            'history_id': history_id
+        }
+    
+    def search_emails(self, credentials: Credentials, person: str, date_from: str = None, date_to: str = None,
+                      metadata_only: bool = True, max_results: int = None) -> List[Dict]:
+        """Search emails from a specific person with date filtering - searches ALL folders including Updates
+        
+        By default only the Subject/From/Date headers, snippet and labels are downloaded
+        (format='metadata' with a fields mask). Pass metadata_only=False to fetch full payloads.
+        All result pages are followed up to max_results; use iter_emails to stream them instead.
+        """
+        emails = []
+        try:
+            print(f"\n=== Starting Gmail Search ===")
+            print(f"Searching for emails from: {person}")
+            print(f"Date range: {date_from} to {date_to}")
+            print(f"Note: Searching across ALL Gmail folders (Primary, Updates, Social, Promotions, etc.)")
+            
+            for chunk in self.iter_emails(credentials, person, date_from, date_to,
+                                          max_results=max_results, metadata_only=metadata_only):
+                emails.extend(chunk)
+            
+            folder_counts = {}
+            for email in emails:
                 # Track folder distribution
-                folder_counts[folder] = folder_counts.get(folder, 0) + 1
-                
-                # Check if this is a Drive sharing notification
-                is_drive_share = 'shared' in subject.lower() and 'drive' in subject.lower()
-                if is_drive_share:
-                    print(f"  ✓ Found Drive sharing email in {folder}: {subject}")
+                folder_counts[email['folder']] = folder_counts.get(email['folder'], 0) + 1
                 
-                emails.append({
-                    'id': message['id'],
-                    'subject': subject,
-                    'from_': from_email,
-                    'date': date,
-                    'snippet': snippet,
-                    'folder': folder,
-                    'is_drive_share': is_drive_share
-                })
+                if email['is_drive_share']:
+                    print(f"  ✓ Found Drive sharing email in {email['folder']}: {email['subject']}")
             
             print(f"\n=== Gmail Folder Distribution ===")
             for folder, count in folder_counts.items():
                 print(f"  {folder}: {count} emails")
             
-            print(f"=== Gmail Search Complete: {len(emails)} emails ===\n")
+            print(f"=== Gmail Search Complete: {len(emails)} emails ({self.round_trips.get('gmail', 0)} Gmail round-trips so far) ===\n")
             return emails
         except Exception as e:
-            print(f"CRITICAL ERROR in search_emails: {str(e)}")
+            print(f"CRITICAL ERROR in search_emails: {str(e)} (returning {len(emails)} emails fetched before the error)")
             import traceback
             traceback.print_exc()
-            return []
+            return emails
     
-    def search_documents(self, credentials: Credentials, person: str, date_from: str = None, date_to: str = None) -> List[Dict]:
-        """Search documents shared by a specific person - includes both owned AND shared files"""
+    def _drive_file_to_document(self, file: Dict, person: str) -> Optional[Dict]:
+        """Convert a Drive file into a document result if it is owned or shared by person, else None"""
+        # Get owner information
+        owners = file.get('owners', [])
+        owner_emails = [owner.get('emailAddress', '').lower() for owner in owners]
+        
+        # Get sharing user (person who shared it with you)
+        sharing_user = file.get('sharingUser', {})
+        sharing_email = sharing_user.get('emailAddress', '').lower() if sharing_user else ''
+        
+        # Check if file is related to this person (owner OR sharer)
+        person_lower = person.lower()
+        is_owner_match = any(person_lower in email for email in owner_emails)
+        is_sharer_match = person_lower in sharing_email if sharing_email else False
+        
+        if not (is_owner_match or is_sharer_match):
+            print(f"  ✗ Skipping: {file['name']} (owners: {owner_emails}, sharer: {sharing_email}, looking for: {person})")
+            return None
+        
+        mime_type = file.get('mimeType', '')
+        doc_type = 'Document'
+        
+        if 'spreadsheet' in mime_type:
+            doc_type = 'Spreadsheet'
+        elif 'presentation' in mime_type:
+            doc_type = 'Presentation'
+        elif 'pdf' in mime_type:
+            doc_type = 'PDF'
+        elif 'image' in mime_type:
+            doc_type = 'Image'
+        elif 'document' in mime_type:
+            doc_type = 'Document'
+        elif 'folder' in mime_type:
+            return None  # Skip folders
+        
+        match_reason = []
+        if is_owner_match:
+            match_reason.append(f"owned by {owner_emails}")
+        if is_sharer_match:
+            match_reason.append(f"shared by {sharing_email}")
+        
+        print(f"  ✓ Adding: {file['name']} (Type: {doc_type}, {', '.join(match_reason)})")
+        
+        return {
+            'id': file['id'],
+            'name': file['name'],
+            'type': doc_type,
+            'mime_type': mime_type,
+            'modified_time': file.get('modifiedTime', ''),
+            'web_view_link': file.get('webViewLink', ''),
+            'owner_emails': owner_emails,
+            'shared_by': sharing_email,
+            'match_reason': ', '.join(match_reason)
+        }
+    
+    def _list_drive_files(self, credentials: Credentials, query: str, max_results: int = None) -> List[Dict]:
+        """Run one Drive files().list query, following nextPageToken up to max_results files"""
+        max_results = max_results if max_results is not None else self.DRIVE_SEARCH_CAP
+        
+        # Each worker thread gets its own service: httplib2 transports are not thread-safe
+        service = get_service('drive', 'v3', credentials)
+        
+        files = []
+        page_token = None
+        while len(files) < max_results:
+            results = service.files().list(
+                q=query,
+                pageSize=min(self.DRIVE_PAGE_SIZE, max_results - len(files)),
+                pageToken=page_token,
+                fields=f"nextPageToken, files({self.DRIVE_FILE_FIELDS})",
+                orderBy="modifiedTime desc",
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True
+            ).execute()
+            self._record_round_trip('drive')
+            
+            files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        
+        return files
+    
+    def get_drive_start_page_token(self, credentials: Credentials) -> str:
+        """Return the current Drive changes cursor (the starting point for the next incremental sync)"""
+        service = get_service('drive', 'v3', credentials)
+        result = service.changes().getStartPageToken(supportsAllDrives=True).execute()
+        self._record_round_trip('drive')
+        return result.get('startPageToken')
+    
+    def list_drive_changes(self, credentials: Credentials, page_token: str) -> Optional[Dict]:
+        """Fetch every Drive change since page_token using changes.list
+        
+        Returns {'changes': [...], 'new_start_page_token': cursor for the next sync}, or None
+        when page_token is no longer valid and a full search is required. When nothing has
+        changed this costs a single call.
+        """
+        print(f"\n=== Starting Incremental Drive Sync ===")
+        service = get_service('drive', 'v3', credentials)
+        
+        changes = []
+        new_start_page_token = None
+        try:
+            while page_token:
+                results = service.changes().list(
+                    pageToken=page_token,
+                    pageSize=self.DRIVE_PAGE_SIZE,
+                    fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({self.DRIVE_FILE_FIELDS}, trashed))",
+                    includeRemoved=True,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True
+                ).execute()
+                self._record_round_trip('drive')
+                
+                changes.extend(results.get('changes', []))
+                new_start_page_token = results.get('newStartPageToken', new_start_page_token)
+                page_token = results.get('nextPageToken')
+        except HttpError as e:
+            if e.resp.status in (400, 404, 410):
+                print(f"Drive changes token is no longer valid - a full search is required: {str(e)}")
+                return None
+            raise
+        
+        print(f"=== Incremental Drive Sync Complete: {len(changes)} changed files ===\n")
+        return {
+            'changes': changes,
+            'new_start_page_token': new_start_page_token
+        }
+    
+    def merge_drive_changes(self, documents: List[Dict], changes: List[Dict], persons: List[str],
+                            date_from: datetime = None, date_to: datetime = None) -> List[Dict]:
+        """Apply Drive changes to a project's cached documents, re-running the owner/sharer match"""
+        changed = {}
+        for change in changes:
+            file = change.get('file')
+            if change.get('removed') or not file or file.get('trashed'):
+                changed[change['fileId']] = None
+                continue
+            
+            document = None
+            if self._drive_file_in_range(file, date_from, date_to):
+                for person in persons:
+                    document = self._drive_file_to_document(file, person)
+                    if document:
+                        break
+            changed[change['fileId']] = document
+        
+        # Changed files are the most recently modified, so they go first
+        updated = sorted(
+            (document for document in changed.values() if document),
+            key=lambda document: document['modified_time'],
+            reverse=True
+        )
+        return updated + [document for document in documents if document['id'] not in changed]
+    
+    def _drive_file_in_range(self, file: Dict, date_from: datetime = None, date_to: datetime = None) -> bool:
+        """Check a Drive file's modifiedTime against the project's date range"""
+        if not (date_from or date_to):
+            return True
+        try:
+            modified = datetime.fromisoformat(file.get('modifiedTime', '').replace('Z', '+00:00'))
+            modified = modified.astimezone(timezone.utc).replace(tzinfo=None)
+        except ValueError:
+            return True
+        if date_from and modified < date_from:
+            return False
+        if date_to and modified > date_to:
+            return False
+        return True
+    
+    @staticmethod
+    def _drive_filters(date_from: str = None, date_to: str = None) -> str:
+        """Query filters shared by every Drive search: no folders, optional modifiedTime range"""
+        # Folders are skipped anyway, so don't transfer them
+        filters = " and mimeType != 'application/vnd.google-apps.folder'"
+        if date_from:
+            # date_from is already in ISO format (YYYY-MM-DDTHH:MM:SS), just use it
+            filters += f" and modifiedTime >= '{date_from}'"
+        if date_to:
+            # date_to is already in ISO format (YYYY-MM-DDTHH:MM:SS), just use it
+            filters += f" and modifiedTime <= '{date_to}'"
+        return filters
+    
+    def list_shared_files(self, credentials: Credentials, date_from: str = None, date_to: str = None) -> Future:
+        """Start listing files shared with the user, newest first, up to DRIVE_SHARED_SEARCH_CAP
+        
+        Pass the returned future to search_documents for every address of a search so the
+        listing runs once instead of once per address.
+        """
+        query = "sharedWithMe=true" + self._drive_filters(date_from, date_to)
+        return _drive_query_executor.submit(self._list_drive_files, credentials, query, self.DRIVE_SHARED_SEARCH_CAP)
+    
+    def search_documents(self, credentials: Credentials, person: str, date_from: str = None, date_to: str = None,
+                         shared_files: Future = None) -> List[Dict]:
+        """Search documents shared by a specific person - includes both owned AND shared files
+        
+        The owner and writer queries run in parallel and every result page is followed (up to
+        DRIVE_SEARCH_CAP files per query). Shared files come from shared_files (see
+        list_shared_files), or from a listing started here when it is not given.
+        """
         try:
             print(f"\n=== Starting Google Drive Search ===")
             print(f"Searching for documents from: {person}")
             print(f"Date range: {date_from} to {date_to}")
             
-            service = build('drive', 'v3', credentials=credentials)
-            
-            # Build multiple query strategies to find documents:
+            # Sources of documents:
             # 1. Files owned by this person
             # 2. Files shared with me from this person
-            # 3. All shared files (we'll filter by person later)
-            queries = []
-            
-            # Query 1: Files owned by specific person
-            queries.append(f"'{person}' in owners")
-            
-            # Query 2: All files shared with me (we'll filter by owner)
-            queries.append("sharedWithMe=true")
-            
-            # Query 3: Files where this person is mentioned
-            queries.append(f"'{person}' in writers")
+            # 3. Files this person can edit
+            # Owner and writer matches are filtered server-side. Drive's q language has no
+            # sharingUser operator, so the shared-with-me listing is matched client-side.
+            filters = self._drive_filters(date_from, date_to)
+            owner_query = f"'{person}' in owners" + filters
+            writer_query = f"'{person}' in writers" + filters
+            sources = [
+                (owner_query, _drive_query_executor.submit(self._list_drive_files, credentials, owner_query)),
+                ("sharedWithMe=true" + filters, shared_files or self.list_shared_files(credentials, date_from, date_to)),
+                (writer_query, _drive_query_executor.submit(self._list_drive_files, credentials, writer_query)),
+            ]
             
             all_files = []
             seen_ids = set()
             
-            for query_index, base_query in enumerate(queries, 1):
-                # Add date filters if provided
-                full_query = base_query
-                if date_from:
-                    # date_from is already in ISO format (YYYY-MM-DDTHH:MM:SS), just use it
-                    full_query += f" and modifiedTime >= '{date_from}'"
-                if date_to:
-                    # date_to is already in ISO format (YYYY-MM-DDTHH:MM:SS), just use it
-                    full_query += f" and modifiedTime <= '{date_to}'"
-                
+            # Merge in query order so results stay deterministic
+            for query_index, (full_query, future) in enumerate(sources, 1):
+                print(f"\n[Query {query_index}] Executed: {full_query}")
                 try:
-                    print(f"\n[Query {query_index}] Executing: {full_query}")
-                    results = service.files().list(
-                        q=full_query,
-                        pageSize=100,
-                        fields="files(id, name, mimeType, modifiedTime, webViewLink, owners, sharingUser, shared, permissions)",
-                        orderBy="modifiedTime desc",
-                        supportsAllDrives=True,
-                        includeItemsFromAllDrives=True
-                    ).execute()
-                    
-                    files = results.get('files', [])
-                    print(f"[Query {query_index}] Returned {len(files)} files")
-                    
-                    for file in files:
-                        # Avoid duplicates
-                        if file['id'] in seen_ids:
-                            continue
-                        
-                        # Get owner information
-                        owners = file.get('owners', [])
-                        owner_emails = [owner.get('emailAddress', '').lower() for owner in owners]
-                        
-                        # Get sharing user (person who shared it with you)
-                        sharing_user = file.get('sharingUser', {})
-                        sharing_email = sharing_user.get('emailAddress', '').lower() if sharing_user else ''
-                        
-                        # Check if file is related to this person (owner OR sharer)
-                        person_lower = person.lower()
-                        is_owner_match = any(person_lower in email for email in owner_emails)
-                        is_sharer_match = person_lower in sharing_email if sharing_email else False
-                        
-                        if is_owner_match or is_sharer_match:
-                            mime_type = file.get('mimeType', '')
-                            doc_type = 'Document'
-                            
-                            if 'spreadsheet' in mime_type:
-                                doc_type = 'Spreadsheet'
-                            elif 'presentation' in mime_type:
-                                doc_type = 'Presentation'
-                            elif 'pdf' in mime_type:
-                                doc_type = 'PDF'
-                            elif 'image' in mime_type:
-                                doc_type = 'Image'
-                            elif 'document' in mime_type:
-                                doc_type = 'Document'
-                            elif 'folder' in mime_type:
-                                continue  # Skip folders
-                            
-                            match_reason = []
-                            if is_owner_match:
-                                match_reason.append(f"owned by {owner_emails}")
-                            if is_sharer_match:
-                                match_reason.append(f"shared by {sharing_email}")
-                            
-                            print(f"  ✓ Adding: {file['name']} (Type: {doc_type}, {', '.join(match_reason)})")
-                            
-                            all_files.append({
-                                'id': file['id'],
-                                'name': file['name'],
-                                'type': doc_type,
-                                'mime_type': mime_type,
-                                'modified_time': file.get('modifiedTime', ''),
-                                'web_view_link': file.get('webViewLink', ''),
-                                'owner_emails': owner_emails,
-                                'shared_by': sharing_email,
-                                'match_reason': ', '.join(match_reason)
-                            })
-                            seen_ids.add(file['id'])
-                        else:
-                            print(f"  ✗ Skipping: {file['name']} (owners: {owner_emails}, sharer: {sharing_email}, looking for: {person})")
+                    files = future.result()
                 except Exception as e:
                     print(f"[Query {query_index}] ERROR: {str(e)}")
                     import traceback
                     traceback.print_exc()
                     continue
+                
+                print(f"[Query {query_index}] Returned {len(files)} files")
+                for file in files:
+                    # Avoid duplicates
+                    if file['id'] in seen_ids:
+                        continue
+                    
+                    document = self._drive_file_to_document(file, person)
+                    if document:
+                        all_files.append(document)
+                        seen_ids.add(file['id'])
             
             print(f"\n=== Drive Search Complete ===")
             print(f"Total unique files found: {len(all_files)}")
@@ -300,7 +671,7 @@ class GoogleServicesManager:
             print(f"To: {to}")
             print(f"Subject: {subject}")
             
-            service = build('gmail', 'v1', credentials=credentials)
+            service = get_service('gmail', 'v1', credentials)
             
             # Create the email
             message = MIMEText(body)
@@ -1,4 +1,6 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
@@ -9,15 +11,24 @@ import jwt
 from datetime import datetime, timedelta
 import json
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-from database import get_db, init_db, User, GoogleCredentials, Project, ChatMessage, Thread, Contact, Deal, Task, Note, EmailLog
+from database import get_db, init_db, SessionLocal, User, GoogleCredentials, Project, ChatMessage, Thread, Contact, Deal, Task, Note, EmailLog, SyncState
 from google_services import GoogleServicesManager
 from document_parser import DocumentParser
 from ai_analyzer import AIAnalyzer
+from credentials_broker import credentials_broker
+from rate_limiter import rate_limiter
+from content_cache import content_cache
+from preparser import preparser
+from search_index import search_index
+from response_cache import response_cache, summary_cache
 
 app = FastAPI(title="Tivrag API")
 
@@ -35,6 +46,20 @@ security = HTTPBearer()
 SECRET_KEY = "your-secret-key-change-in-production"
 ALGORITHM = "HS256"
 
+# Gmail/Drive search threads shared by all project searches. They live for the process so each
+# keeps its Google API clients and HTTP connections (see google_client.get_service)
+SEARCH_MAX_WORKERS = int(os.getenv("SEARCH_MAX_WORKERS", "8"))
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS, thread_name_prefix="project-search")
+
+# Documents parsed per analysis, parser threads shared by all analysis requests, and how long
+# an analysis waits for document parsing before continuing without the unfinished documents
+ANALYZE_MAX_DOCUMENTS = int(os.getenv("ANALYZE_MAX_DOCUMENTS", "5"))
+ANALYZE_PARSE_WORKERS = int(os.getenv("ANALYZE_PARSE_WORKERS", "4"))
+ANALYZE_DOCUMENT_TIMEOUT_SECONDS = float(os.getenv("ANALYZE_DOCUMENT_TIMEOUT_SECONDS", "30"))
+# Chunks retrieved from the project's search index; AIAnalyzer keeps as many as its token budget allows
+ANALYZE_CONTEXT_CHUNKS = int(os.getenv("ANALYZE_CONTEXT_CHUNKS", "60"))
+document_parse_executor = ThreadPoolExecutor(max_workers=ANALYZE_PARSE_WORKERS, thread_name_prefix="analyze-parse")
+
 # Pydantic models
 class SignupRequest(BaseModel):
     username: str
@@ -100,6 +125,8 @@ class AnalyzeRequest(BaseModel):
     thread_id: Optional[int] = None
     parse_documents: bool = False
     parse_emails: bool = False
+    use_cache: bool = True  # False forces a fresh AI completion
+    map_reduce: bool = False  # Summarize all items in batches and answer from the summaries
 
 class ThreadCreateRequest(BaseModel):
     project_id: int
@@ -128,6 +155,8 @@ class AnalyzeResponse(BaseModel):
     parsed_count: Dict[str, int]
     message_id: int
     thread_id: int
+    context_usage: Optional[Dict] = None
+    cached: bool = False
 
 # CRM Pydantic Models
 class ContactCreate(BaseModel):
@@ -281,6 +310,67 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
         raise HTTPException(status_code=401, detail="User not found")
     return user
 
+def store_late_document(project_id: int, doc: Dict, future):
+    """Save a document that finished parsing after its analysis request stopped waiting for it"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    db = SessionLocal()
+    try:
+        if db.get(Project, project_id) is not None:
+            content_cache.put_document(db, project_id, doc['id'], doc.get('modified_time'), future.result())
+            search_index.index_content(db, project_id, 'document', doc['id'], future.result())
+            db.commit()
+    except Exception as e:
+        print(f"Failed to store late parse of document {doc['id']}: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+def parse_documents_concurrently(credentials, project_id: int, documents: List[Dict]) -> Dict[str, str]:
+    """Parse documents on the shared parser pool and return their text by file ID
+    
+    Documents still parsing ANALYZE_DOCUMENT_TIMEOUT_SECONDS after submission are left out;
+    they keep running and are stored when done, so the next analysis finds them.
+    """
+    futures = {
+        document_parse_executor.submit(DocumentParser.parse_document, credentials, doc['id'], doc.get('mime_type', '')): doc
+        for doc in documents
+    }
+    done, not_done = wait(futures, timeout=ANALYZE_DOCUMENT_TIMEOUT_SECONDS)
+    
+    contents = {}
+    for future in done:
+        doc = futures[future]
+        try:
+            contents[doc['id']] = future.result()
+        except Exception as e:
+            print(f"Error parsing document {doc['id']}: {e}")
+    for future in not_done:
+        doc = futures[future]
+        print(f"Document {doc.get('name', doc['id'])} not parsed within {ANALYZE_DOCUMENT_TIMEOUT_SECONDS}s, analyzing without it")
+        future.add_done_callback(lambda future, doc=doc: store_late_document(project_id, doc, future))
+    return contents
+
+def apply_drive_changes_to_projects(db: Session, user_id: int, exclude_project_id: int, changes: List[Dict], google_manager: GoogleServicesManager):
+    """Apply Drive changes to the cached documents of every Drive-tracked project of a user"""
+    projects = db.query(Project).filter(
+        Project.user_id == user_id,
+        Project.id != exclude_project_id,
+        Project.include_drive == True
+    ).all()
+    
+    for other in projects:
+        if not other.search_results:
+            continue
+        results = json.loads(other.search_results)
+        if not results.get("drive_tracked"):
+            continue
+        addresses = [email.strip() for email in other.search_email.split(',') if email.strip()]
+        results["documents"] = google_manager.merge_drive_changes(
+            results.get("documents", []), changes, addresses, other.date_from, other.date_to
+        )
+        other.search_results = json.dumps(results)
+
 # Auth endpoints
 @app.post("/api/signup", response_model=TokenResponse)
 def signup(request: SignupRequest, db: Session = Depends(get_db)):
@@ -350,6 +440,7 @@ def google_callback(request: GoogleAuthRequest, current_user: User = Depends(get
             db.add(new_creds)
         
         db.commit()
+        credentials_broker.invalidate(current_user.id)
         return {"status": "success", "message": "Google services connected successfully"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -372,42 +463,44 @@ def disconnect_google(current_user: User = Depends(get_current_user), db: Sessio
     creds = db.query(GoogleCredentials).filter(GoogleCredentials.user_id == current_user.id).first()
     if creds:
         db.delete(creds)
+        # Sync cursors belong to the disconnected account's mailbox
+        db.query(SyncState).filter(SyncState.user_id == current_user.id).delete()
+        content_cache.remove_user_emails(db, current_user.id)
         db.commit()
+        credentials_broker.invalidate(current_user.id)
     return {"status": "success", "message": "Google services disconnected"}
 
+@app.get("/api/google/metrics")
+def get_google_metrics(current_user: User = Depends(get_current_user)):
+    """Google API rate limiter metrics (requests, quota units, throttling and retries per API)"""
+    return rate_limiter.get_metrics()
+
+@app.get("/api/content-cache/stats")
+def get_content_cache_stats(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Parsed-content cache hit/miss counters and size, plus background pre-parse progress"""
+    return dict(content_cache.get_stats(db), preparse=preparser.get_stats())
+
+@app.get("/api/ai/response-cache/stats")
+def get_response_cache_stats(current_user: User = Depends(get_current_user)):
+    """AI analysis response cache hit/miss counters, plus the map-reduce batch summary cache"""
+    return dict(response_cache.get_stats(), summaries=summary_cache.get_stats())
+
 # Search endpoint
 @app.post("/api/search", response_model=SearchResponse)
 def search(request: SearchRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     """Search emails and documents from a specific person"""
     # Get user's Google credentials
-    creds = db.query(GoogleCredentials).filter(GoogleCredentials.user_id == current_user.id).first()
-    if not creds:
+    credentials = credentials_broker.get_credentials(current_user.id)
+    if not credentials:
         raise HTTPException(status_code=400, detail="Google services not connected. Please connect in Configuration.")
     
     try:
         google_manager = GoogleServicesManager()
         
-        # Reconstruct credentials
-        from google.oauth2.credentials import Credentials
-        credentials = Credentials(
-            token=creds.access_token,
-            refresh_token=creds.refresh_token,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=google_manager.client_id,
-            client_secret=google_manager.client_secret,
-            scopes=json.loads(creds.scopes) if creds.scopes else []
-        )
-        
         # Search emails and documents
         emails = google_manager.search_emails(credentials, request.person)
         documents = google_manager.search_documents(credentials, request.person)
         
-        # Update credentials if refreshed
-        if credentials.token != creds.access_token:
-            creds.access_token = credentials.token
-            creds.updated_at = datetime.utcnow()
-            db.commit()
-        
         return SearchResponse(emails=emails, documents=documents)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
@@ -499,6 +592,13 @@ def delete_project(project_id: int, current_user: User = Depends(get_current_use
     # Delete all threads for this project
     db.query(Thread).filter(Thread.project_id == project_id).delete()
     
+    # Delete sync cursors for this project
+    db.query(SyncState).filter(SyncState.project_id == project_id).delete()
+    
+    # Release the project's parsed documents; text no other project uses is deleted
+    content_cache.release_project(db, project_id)
+    search_index.remove_project(db, project_id)
+    
     # Delete the project
     db.delete(project)
     db.commit()
@@ -507,15 +607,20 @@ def delete_project(project_id: int, current_user: User = Depends(get_current_use
 
 # Project Search Endpoint
 @app.post("/api/projects/{project_id}/search")
-def search_project(project_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Execute search for a project and cache results - supports multiple comma-separated emails"""
+def search_project(project_id: int, full_refresh: bool = False, merge_gmail_query: bool = False, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Execute search for a project and cache results - supports multiple comma-separated emails
+    
+    After the first search, Gmail results are refreshed incrementally from the mailbox history
+    recorded at the last sync. Pass full_refresh=true to re-run the whole Gmail query.
+    Addresses are searched concurrently; merge_gmail_query=true sends one from:(a OR b) Gmail query.
+    """
     project = db.query(Project).filter(Project.id == project_id, Project.user_id == current_user.id).first()
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
     
     # Get user's Google credentials
-    creds = db.query(GoogleCredentials).filter(GoogleCredentials.user_id == current_user.id).first()
-    if not creds:
+    credentials = credentials_broker.get_credentials(current_user.id)
+    if not credentials:
         raise HTTPException(status_code=400, detail="Google services not connected. Please connect in Configuration.")
     
     try:
@@ -530,17 +635,6 @@ def search_project(project_id: int, current_user: User = Depends(get_current_use
         
         google_manager = GoogleServicesManager()
         
-        # Reconstruct credentials
-        from google.oauth2.credentials import Credentials
-        credentials = Credentials(
-            token=creds.access_token,
-            refresh_token=creds.refresh_token,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=google_manager.client_id,
-            client_secret=google_manager.client_secret,
-            scopes=json.loads(creds.scopes) if creds.scopes else []
-        )
-        
         print(f"Credentials scopes: {credentials.scopes}")
         
         # Prepare date filters (Gmail uses YYYY/MM/DD format)
@@ -558,38 +652,171 @@ def search_project(project_id: int, current_user: User = Depends(get_current_use
         seen_email_ids = set()
         seen_doc_ids = set()
         
-        # Search for each email address
-        for email_addr in email_addresses:
-            print(f"\n--- Searching for: {email_addr} ---")
-            
-            if project.include_gmail:
-                try:
-                    emails_from_person = google_manager.search_emails(credentials, email_addr, date_from_str, date_to_str)
-                    # Deduplicate emails
-                    for email in emails_from_person:
-                        if email['id'] not in seen_email_ids:
+        # Read the cached results before partial results start overwriting them
+        cached_results = json.loads(project.search_results) if project.search_results else None
+        
+        # Incremental Gmail refresh: merge history changes since the last sync into the cached emails
+        gmail_synced = False
+        gmail_failed = False
+        new_history_id = None
+        gmail_state = db.query(SyncState).filter(
+            SyncState.project_id == project_id,
+            SyncState.service == 'gmail'
+        ).first()
+        if project.include_gmail and gmail_state and cached_results and not full_refresh:
+            try:
+                delta = google_manager.sync_emails(
+                    credentials, gmail_state.cursor, email_addresses, project.date_from, project.date_to
+                )
+                if delta is not None:
+                    deleted_ids = set(delta['deleted'])
+                    cached_emails = cached_results.get("emails", [])
+                    # New messages first to keep newest-first ordering
+                    for email in delta['added'] + cached_emails:
+                        if email['id'] not in seen_email_ids and email['id'] not in deleted_ids:
                             all_emails.append(email)
                             seen_email_ids.add(email['id'])
-                    print(f"Gmail: Found {len(emails_from_person)} emails from {email_addr} (Total unique: {len(all_emails)})")
-                except Exception as e:
-                    error_msg = f"Gmail search failed for {email_addr}: {str(e)}"
-                    print(f"ERROR: {error_msg}")
-                    search_errors.append(error_msg)
+                    new_history_id = delta['history_id']
+                    gmail_synced = True
+                    print(f"Gmail: Incremental sync added {len(delta['added'])}, removed {len(deleted_ids)} (Total: {len(all_emails)})")
+            except Exception as e:
+                print(f"Incremental Gmail sync failed, falling back to full search: {str(e)}")
+        
+        if project.include_gmail and not gmail_synced:
+            # Record the mailbox position before searching so nothing arriving mid-search is missed next time
+            try:
+                new_history_id = google_manager.get_history_id(credentials)
+            except Exception as e:
+                print(f"Could not read Gmail historyId, next refresh will be a full search: {str(e)}")
+        
+        # Incremental Drive refresh: apply changes since the user's last Drive sync to the cached documents
+        drive_synced = False
+        drive_failed = False
+        new_drive_token = None
+        drive_state = db.query(SyncState).filter(
+            SyncState.user_id == current_user.id,
+            SyncState.project_id == None,
+            SyncState.service == 'drive'
+        ).first()
+        if (project.include_drive and drive_state and cached_results and cached_results.get("drive_tracked")
+                and not full_refresh):
+            try:
+                delta = google_manager.list_drive_changes(credentials, drive_state.cursor)
+                if delta is not None:
+                    # The cursor is shared by all of the user's projects, so every tracked project gets the changes
+                    if delta['changes']:
+                        apply_drive_changes_to_projects(db, current_user.id, project_id, delta['changes'], google_manager)
+                    for doc in google_manager.merge_drive_changes(
+                        cached_results.get("documents", []), delta['changes'],
+                        email_addresses, project.date_from, project.date_to
+                    ):
+                        all_documents.append(doc)
+                        seen_doc_ids.add(doc['id'])
+                    new_drive_token = delta['new_start_page_token']
+                    drive_synced = True
+                    print(f"Drive: Incremental sync applied {len(delta['changes'])} changes (Total: {len(all_documents)})")
+            except Exception as e:
+                print(f"Incremental Drive sync failed, falling back to full search: {str(e)}")
+        
+        if project.include_drive and not drive_synced and not drive_state:
+            # Start tracking Drive changes for this user from before the search
+            try:
+                new_drive_token = google_manager.get_drive_start_page_token(credentials)
+            except Exception as e:
+                print(f"Could not read Drive start page token, next refresh will be a full search: {str(e)}")
+        
+        def persist_partial_results():
+            """Save what has been found so far so the project shows results while the search runs"""
+            project.search_results = json.dumps({
+                "emails": all_emails,
+                "documents": all_documents,
+                "searched_at": datetime.utcnow().isoformat(),
+                "search_errors": search_errors,
+                "in_progress": True
+            })
+            db.commit()
+        
+        # Gmail targets: one query per address, or a single from:(a OR b) query when merged
+        gmail_targets = []
+        if project.include_gmail and not gmail_synced:
+            if merge_gmail_query and len(email_addresses) > 1:
+                gmail_targets = [GoogleServicesManager.combine_senders(email_addresses)]
+            else:
+                gmail_targets = list(email_addresses)
+        if gmail_targets and gmail_state:
+            # A full search replaces the cached emails, so drop the old cursor (committed with the first
+            # partial results). If any address fails or the search is interrupted, the next refresh is a
+            # full search again instead of history applied to a partial list.
+            db.delete(gmail_state)
+            gmail_state = None
+        drive_targets = list(email_addresses) if project.include_drive and not drive_synced else []
+        
+        # Drive uses ISO format
+        drive_date_from = project.date_from.isoformat() if project.date_from else None
+        drive_date_to = project.date_to.isoformat() if project.date_to else None
+        # Files shared with the user are listed once and matched against every address
+        shared_files = google_manager.list_shared_files(credentials, drive_date_from, drive_date_to) if drive_targets else None
+        
+        # Workers only talk to Google and hand their results to this thread, which owns the DB session
+        results_queue = queue.Queue()
+        
+        def gmail_task(target):
+            # Stream Gmail results page by page so each chunk can be merged and persisted as it arrives
+            found = 0
+            for chunk in google_manager.iter_emails(credentials, target, date_from_str, date_to_str):
+                found += len(chunk)
+                results_queue.put(('gmail', chunk))
+            return found
+        
+        def drive_task(target):
+            docs = google_manager.search_documents(credentials, target, drive_date_from, drive_date_to, shared_files)
+            results_queue.put(('drive', docs))
+            return len(docs)
+        
+        def merge_results(service, items):
+            # Deduplicate on message/file ID
+            if service == 'gmail':
+                for email in items:
+                    if email['id'] not in seen_email_ids:
+                        all_emails.append(email)
+                        seen_email_ids.add(email['id'])
+            else:
+                for doc in items:
+                    if doc['id'] not in seen_doc_ids:
+                        all_documents.append(doc)
+                        seen_doc_ids.add(doc['id'])
+            persist_partial_results()
+        
+        print(f"Running {len(gmail_targets)} Gmail and {len(drive_targets)} Drive search(es) on up to {SEARCH_MAX_WORKERS} workers")
+        futures = {search_executor.submit(gmail_task, target): ('gmail', target) for target in gmail_targets}
+        futures.update({search_executor.submit(drive_task, target): ('drive', target) for target in drive_targets})
+        pending = set(futures)
+        
+        while pending or not results_queue.empty():
+            try:
+                service, items = results_queue.get(timeout=0.1)
+                merge_results(service, items)
+                continue
+            except queue.Empty:
+                pass
             
-            if project.include_drive:
+            finished = {future for future in pending if future.done()}
+            pending -= finished
+            for future in finished:
+                service, target = futures[future]
                 try:
-                    # Drive uses ISO format
-                    drive_date_from = project.date_from.isoformat() if project.date_from else None
-                    drive_date_to = project.date_to.isoformat() if project.date_to else None
-                    docs_from_person = google_manager.search_documents(credentials, email_addr, drive_date_from, drive_date_to)
-                    # Deduplicate documents
-                    for doc in docs_from_person:
-                        if doc['id'] not in seen_doc_ids:
-                            all_documents.append(doc)
-                            seen_doc_ids.add(doc['id'])
-                    print(f"Drive: Found {len(docs_from_person)} documents from {email_addr} (Total unique: {len(all_documents)})")
+                    found = future.result()
+                    if service == 'gmail':
+                        print(f"Gmail: Found {found} emails from {target}")
+                    else:
+                        print(f"Drive: Found {found} documents from {target}")
                 except Exception as e:
-                    error_msg = f"Google Drive search failed for {email_addr}: {str(e)}"
+                    if service == 'gmail':
+                        error_msg = f"Gmail search failed for {target}: {str(e)}"
+                        gmail_failed = True
+                    else:
+                        error_msg = f"Google Drive search failed for {target}: {str(e)}"
+                        drive_failed = True
                     print(f"ERROR: {error_msg}")
                     search_errors.append(error_msg)
         
@@ -598,24 +825,59 @@ def search_project(project_id: int, current_user: User = Depends(get_current_use
         print(f"\n=== Search Summary ===")
         print(f"Total emails: {len(emails)}")
         print(f"Total documents: {len(documents)}")
+        print(f"Google API round-trips: {google_manager.round_trips}")
         
         # Cache results
         results = {
             "emails": emails,
             "documents": documents,
             "searched_at": datetime.utcnow().isoformat(),
-            "search_errors": search_errors
+            "search_errors": search_errors,
+            "api_round_trips": google_manager.round_trips,
+            # Whether these documents are kept current by the user's Drive changes cursor
+            "drive_tracked": bool(project.include_drive and (drive_state or new_drive_token) and not drive_failed)
         }
         project.search_results = json.dumps(results)
         project.updated_at = datetime.utcnow()
         
-        # Update credentials if refreshed
-        if credentials.token != creds.access_token:
-            creds.access_token = credentials.token
-            creds.updated_at = datetime.utcnow()
+        # Only advance the Gmail cursor when every address was searched successfully
+        if new_history_id and not gmail_failed:
+            if gmail_state:
+                gmail_state.cursor = new_history_id
+                gmail_state.updated_at = datetime.utcnow()
+            else:
+                db.add(SyncState(
+                    user_id=current_user.id,
+                    project_id=project_id,
+                    service='gmail',
+                    cursor=new_history_id
+                ))
+        
+        if new_drive_token and not drive_failed:
+            if drive_state:
+                drive_state.cursor = new_drive_token
+                drive_state.updated_at = datetime.utcnow()
+            else:
+                db.add(SyncState(
+                    user_id=current_user.id,
+                    project_id=None,
+                    service='drive',
+                    cursor=new_drive_token
+                ))
         
         db.commit()
         
+        # Add new results to the project's search index
+        try:
+            search_index.index_items(db, project_id, emails, documents)
+            db.commit()
+        except Exception as e:
+            print(f"Failed to index search results: {str(e)}")
+            db.rollback()
+        
+        # Extract the newest documents and email bodies in the background so analysis finds them cached
+        preparser.enqueue_project(current_user.id, project_id, emails, documents)
+        
         print(f"=== Project Search Complete ===\n")
         
         # Return results with any errors
@@ -638,27 +900,25 @@ def search_project(project_id: int, current_user: User = Depends(get_current_use
 
 # Document Parsing Endpoint
 @app.get("/api/documents/{document_id}/parse")
-def parse_document(document_id: str, mime_type: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Parse and extract content from a document"""
+def parse_document(document_id: str, mime_type: str, modified_time: Optional[str] = None, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Parse and extract content from a document (cached when modified_time is given)"""
+    cache_key = content_cache.document_key(current_user.id, document_id, modified_time) if modified_time else None
+    if cache_key:
+        content = content_cache.get(db, cache_key)
+        if content is not None:
+            db.commit()
+            return {"content": content, "document_id": document_id}
+    
     # Get user's Google credentials
-    creds = db.query(GoogleCredentials).filter(GoogleCredentials.user_id == current_user.id).first()
-    if not creds:
+    credentials = credentials_broker.get_credentials(current_user.id)
+    if not credentials:
         raise HTTPException(status_code=400, detail="Google services not connected.")
     
     try:
-        from google.oauth2.credentials import Credentials
-        google_manager = GoogleServicesManager()
-        
-        credentials = Credentials(
-            token=creds.access_token,
-            refresh_token=creds.refresh_token,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=google_manager.client_id,
-            client_secret=google_manager.client_secret,
-            scopes=json.loads(creds.scopes) if creds.scopes else []
-        )
-        
         content = DocumentParser.parse_document(credentials, document_id, mime_type)
+        if cache_key:
+            content_cache.put(db, cache_key, 'document', document_id, content)
+            db.commit()
         
         return {"content": content, "document_id": document_id}
     except Exception as e:
@@ -667,34 +927,28 @@ def parse_document(document_id: str, mime_type: str, current_user: User = Depend
 @app.get("/api/emails/{email_id}/content")
 def get_email_content(email_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     """Get full email content"""
+    cache_key = content_cache.email_key(current_user.id, email_id)
+    content = content_cache.get(db, cache_key)
+    if content is not None:
+        db.commit()
+        return {"content": content, "email_id": email_id}
+    
     # Get user's Google credentials
-    creds = db.query(GoogleCredentials).filter(GoogleCredentials.user_id == current_user.id).first()
-    if not creds:
+    credentials = credentials_broker.get_credentials(current_user.id)
+    if not credentials:
         raise HTTPException(status_code=400, detail="Google services not connected.")
     
     try:
-        from google.oauth2.credentials import Credentials
-        google_manager = GoogleServicesManager()
-        
-        credentials = Credentials(
-            token=creds.access_token,
-            refresh_token=creds.refresh_token,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=google_manager.client_id,
-            client_secret=google_manager.client_secret,
-            scopes=json.loads(creds.scopes) if creds.scopes else []
-        )
-        
         content = DocumentParser.get_email_body(credentials, email_id)
+        content_cache.put(db, cache_key, 'email', email_id, content)
+        db.commit()
         
         return {"content": content, "email_id": email_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get email content: {str(e)}")
 
-# AI Analysis Endpoint
-@app.post("/api/projects/{project_id}/analyze", response_model=AnalyzeResponse)
-def analyze_project(project_id: int, request: AnalyzeRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Analyze project data with AI based on user prompt"""
+def resolve_analysis_thread(project_id: int, request: AnalyzeRequest, current_user: User, db: Session) -> int:
+    """Check the project can be analyzed and return the request's thread id, creating the thread if needed"""
     project = db.query(Project).filter(Project.id == project_id, Project.user_id == current_user.id).first()
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
@@ -720,115 +974,185 @@ def analyze_project(project_id: int, request: AnalyzeRequest, current_user: User
         if not thread:
             raise HTTPException(status_code=404, detail="Thread not found")
         thread.updated_at = datetime.utcnow()
+    return thread_id
+
+def prepare_analysis(project_id: int, thread_id: int, request: AnalyzeRequest, user_id: int, db: Session) -> Dict:
+    """Parse requested emails/documents, pick relevant index chunks and load history for an analysis request"""
+    project = db.query(Project).filter(Project.id == project_id, Project.user_id == user_id).first()
+    if not project or not project.search_results:
+        raise HTTPException(status_code=404, detail="Project not found")
     
-    try:
-        results = json.loads(project.search_results)
-        emails = results.get("emails", [])
-        documents = results.get("documents", [])
-        
-        # Initialize AI analyzer
-        ai_analyzer = AIAnalyzer()
+    results = json.loads(project.search_results)
+    emails = results.get("emails", [])
+    documents = results.get("documents", [])
+    
+    # Optionally parse documents and emails for deeper analysis
+    email_contents = {}
+    document_contents = {}
+    parsed_count = {"emails": 0, "documents": 0}
+    
+    # Parsed content is cached, so Google is only contacted (and credentials loaded) on a cache miss
+    credentials = None
+    
+    if request.parse_emails:
+        # Parse up to 10 emails
+        bodies = {}
+        missing = []
+        for email in emails[:10]:
+            content = content_cache.get(db, content_cache.email_key(user_id, email['id']))
+            if content is None:
+                missing.append(email['id'])
+            else:
+                bodies[email['id']] = content
         
-        # Optionally parse documents and emails for deeper analysis
-        email_contents = {}
-        document_contents = {}
-        parsed_count = {"emails": 0, "documents": 0}
+        if missing:
+            # Fetch all cache misses in one Gmail batch request
+            credentials = credentials_broker.get_credentials(user_id)
+            if credentials:
+                fetched = GoogleServicesManager().get_email_bodies(credentials, missing)
+                for email_id, content in fetched.items():
+                    content_cache.put(db, content_cache.email_key(user_id, email_id), 'email', email_id, content)
+                bodies.update(fetched)
         
-        if request.parse_emails:
-            # Get user's Google credentials
-            creds = db.query(GoogleCredentials).filter(GoogleCredentials.user_id == current_user.id).first()
-            if creds:
-                from google.oauth2.credentials import Credentials
-                google_manager = GoogleServicesManager()
-                
-                credentials = Credentials(
-                    token=creds.access_token,
-                    refresh_token=creds.refresh_token,
-                    token_uri="https://oauth2.googleapis.com/token",
-                    client_id=google_manager.client_id,
-                    client_secret=google_manager.client_secret,
-                    scopes=json.loads(creds.scopes) if creds.scopes else []
-                )
-                
-                # Parse up to 10 emails
-                for email in emails[:10]:
-                    content = DocumentParser.get_email_body(credentials, email['id'])
-                    if content:
-                        email_contents[email['id']] = content
-                        parsed_count["emails"] += 1
-        
-        if request.parse_documents:
-            # Get user's Google credentials
-            creds = db.query(GoogleCredentials).filter(GoogleCredentials.user_id == current_user.id).first()
-            if creds:
-                from google.oauth2.credentials import Credentials
-                google_manager = GoogleServicesManager()
-                
-                credentials = Credentials(
-                    token=creds.access_token,
-                    refresh_token=creds.refresh_token,
-                    token_uri="https://oauth2.googleapis.com/token",
-                    client_id=google_manager.client_id,
-                    client_secret=google_manager.client_secret,
-                    scopes=json.loads(creds.scopes) if creds.scopes else []
-                )
-                
-                # Parse up to 5 documents
-                for doc in documents[:5]:
-                    content = DocumentParser.parse_document(credentials, doc['id'], doc.get('mime_type', ''))
-                    if content:
-                        document_contents[doc['id']] = content
-                        parsed_count["documents"] += 1
+        for email in emails[:10]:
+            content = bodies.get(email['id'])
+            if content:
+                email_contents[email['id']] = content
+                parsed_count["emails"] += 1
+    
+    if request.parse_documents:
+        # Parse up to ANALYZE_MAX_DOCUMENTS documents
+        selected = documents[:ANALYZE_MAX_DOCUMENTS]
+        contents = {}
+        missing = []
+        for doc in selected:
+            # Text extracted for any project is shared, so each file revision is parsed once
+            content = content_cache.get_document(db, project_id, doc['id'], doc.get('modified_time'))
+            if content is None:
+                missing.append(doc)
+            else:
+                contents[doc['id']] = content
         
-        # Get conversation history for this thread
-        chat_history = db.query(ChatMessage).filter(
-            ChatMessage.thread_id == thread_id
-        ).order_by(ChatMessage.created_at).all()
+        if missing:
+            credentials = credentials or credentials_broker.get_credentials(user_id)
+            if credentials:
+                parsed = parse_documents_concurrently(credentials, project_id, missing)
+                for doc in missing:
+                    if doc['id'] in parsed:
+                        content_cache.put_document(db, project_id, doc['id'], doc.get('modified_time'), parsed[doc['id']])
+                contents.update(parsed)
         
-        # Build conversation context
-        conversation_messages = []
-        for msg in chat_history[-10:]:  # Last 10 messages for context
-            conversation_messages.append({
-                "role": msg.role,
-                "content": msg.content
-            })
+        for doc in selected:
+            content = contents.get(doc['id'])
+            if content:
+                document_contents[doc['id']] = content
+                parsed_count["documents"] += 1
+    
+    # Keep the project's search index current with the results and any text extracted above,
+    # then pick the chunks most relevant to the prompt
+    search_index.index_items(db, project_id, emails, documents)
+    for email_id, content in email_contents.items():
+        search_index.index_content(db, project_id, 'email', email_id, content)
+    for doc_id, content in document_contents.items():
+        search_index.index_content(db, project_id, 'document', doc_id, content)
+    
+    if request.map_reduce:
+        # Map-reduce analysis covers every item, with whatever text is already cached (no Google calls)
+        for email in emails:
+            if email['id'] not in email_contents:
+                content = content_cache.get(db, content_cache.email_key(user_id, email['id']))
+                if content:
+                    email_contents[email['id']] = content
+        for doc in documents:
+            if doc['id'] not in document_contents:
+                content = content_cache.get_document(db, project_id, doc['id'], doc.get('modified_time'))
+                if content:
+                    document_contents[doc['id']] = content
+    
+    items = {('email', email['id']): email for email in emails}
+    items.update({('document', doc['id']): doc for doc in documents})
+    relevant_chunks = []
+    for chunk in search_index.search(db, project_id, request.prompt, ANALYZE_CONTEXT_CHUNKS):
+        # Skip chunks of items no longer in the search results
+        item = items.get((chunk['source_type'], chunk['source_id']))
+        if item is not None:
+            relevant_chunks.append(dict(chunk, item=item))
+    
+    # Get conversation history for this thread
+    chat_history = db.query(ChatMessage).filter(
+        ChatMessage.thread_id == thread_id
+    ).order_by(ChatMessage.created_at).all()
+    
+    # Build conversation context (AIAnalyzer keeps as much recent history as its token budget allows)
+    conversation_messages = []
+    for msg in chat_history:
+        conversation_messages.append({
+            "role": msg.role,
+            "content": msg.content
+        })
+    
+    return {
+        "thread_id": thread_id,
+        "emails": emails,
+        "documents": documents,
+        "email_contents": email_contents if email_contents else None,
+        "document_contents": document_contents if document_contents else None,
+        "parsed_count": parsed_count,
+        "conversation_history": conversation_messages,
+        "relevant_chunks": relevant_chunks
+    }
+
+def save_chat_message(db: Session, thread_id: int, project_id: int, user_id: int, role: str, content: str,
+                      parsed_count: Dict, parse_emails: bool = False, parse_documents: bool = False) -> ChatMessage:
+    message = ChatMessage(
+        thread_id=thread_id,
+        project_id=project_id,
+        user_id=user_id,
+        role=role,
+        content=content,
+        parse_emails=parse_emails,
+        parse_documents=parse_documents,
+        parsed_count=json.dumps(parsed_count)
+    )
+    db.add(message)
+    db.flush()
+    return message
+
+def sse_event(event: str, data: Dict) -> str:
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# AI Analysis Endpoint
+@app.post("/api/projects/{project_id}/analyze", response_model=AnalyzeResponse)
+def analyze_project(project_id: int, request: AnalyzeRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Analyze project data with AI based on user prompt"""
+    try:
+        thread_id = resolve_analysis_thread(project_id, request, current_user, db)
+        analysis_input = prepare_analysis(project_id, thread_id, request, current_user.id, db)
+        parsed_count = analysis_input["parsed_count"]
+        # Release the database write lock while waiting for the model
+        db.commit()
         
         # Perform AI analysis with conversation context
+        ai_analyzer = AIAnalyzer()
         analysis = ai_analyzer.analyze_data(
             request.prompt,
-            emails,
-            documents,
-            email_contents if email_contents else None,
-            document_contents if document_contents else None,
-            conversation_history=conversation_messages
+            analysis_input["emails"],
+            analysis_input["documents"],
+            analysis_input["email_contents"],
+            analysis_input["document_contents"],
+            conversation_history=analysis_input["conversation_history"],
+            relevant_chunks=analysis_input["relevant_chunks"],
+            use_cache=request.use_cache,
+            map_reduce=request.map_reduce
         )
         
-        # Save user message
-        user_message = ChatMessage(
-            thread_id=thread_id,
-            project_id=project_id,
-            user_id=current_user.id,
-            role="user",
-            content=request.prompt,
-            parse_emails=request.parse_emails,
-            parse_documents=request.parse_documents,
-            parsed_count=json.dumps(parsed_count)
+        # Save user message and assistant response
+        save_chat_message(
+            db, thread_id, project_id, current_user.id, "user", request.prompt, parsed_count,
+            parse_emails=request.parse_emails, parse_documents=request.parse_documents
         )
-        db.add(user_message)
-        db.flush()
-        
-        # Save assistant response
-        assistant_message = ChatMessage(
-            thread_id=thread_id,
-            project_id=project_id,
-            user_id=current_user.id,
-            role="assistant",
-            content=analysis,
-            parse_emails=False,
-            parse_documents=False,
-            parsed_count=json.dumps(parsed_count)
-        )
-        db.add(assistant_message)
+        assistant_message = save_chat_message(db, thread_id, project_id, current_user.id, "assistant", analysis, parsed_count)
         db.commit()
         db.refresh(assistant_message)
         
@@ -836,12 +1160,121 @@ def analyze_project(project_id: int, request: AnalyzeRequest, current_user: User
             analysis=analysis, 
             parsed_count=parsed_count,
             message_id=assistant_message.id,
-            thread_id=thread_id
+            thread_id=thread_id,
+            context_usage=ai_analyzer.last_context_usage,
+            cached=ai_analyzer.last_cache_hit
         )
-        
+    
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
+@app.post("/api/projects/{project_id}/analyze/stream")
+def analyze_project_stream(project_id: int, request: AnalyzeRequest, http_request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Analyze project data with AI, streaming progress and the answer as Server-Sent Events
+    
+    Events: "start" (thread_id) straight away, "progress" (stage, and batch counts while map-reduce
+    summarizes), "context" (parsed_count) once emails/documents are prepared, "token" (delta) for
+    each piece of the answer, then "done" (message_id, context_usage, cached) once the assistant
+    message is saved, or "error" (detail). If the client disconnects, the model stream is closed
+    and the partial answer is saved.
+    """
+    thread_id = resolve_analysis_thread(project_id, request, current_user, db)
+    user_id = current_user.id
+    db.commit()
+    
+    # Preparation, the model stream and saving run on their own thread with their own session, so
+    # the client gets "start" at once and the message is stored even if the client goes away
+    events_queue = queue.Queue()
+    stop = threading.Event()
+    ai_analyzer = AIAnalyzer()
+    ai_analyzer.on_progress = lambda stage, data: events_queue.put(("progress", dict(data, stage=stage)))
+    outcome = {"parsed_count": {"emails": 0, "documents": 0}}
+    
+    def run_analysis():
+        work_db = SessionLocal()
+        try:
+            events_queue.put(("progress", {"stage": "preparing"}))
+            analysis_input = prepare_analysis(project_id, thread_id, request, user_id, work_db)
+            parsed_count = outcome["parsed_count"] = analysis_input["parsed_count"]
+            save_chat_message(
+                work_db, thread_id, project_id, user_id, "user", request.prompt, parsed_count,
+                parse_emails=request.parse_emails, parse_documents=request.parse_documents
+            )
+            # Save the prompt now so the write lock is not held while the answer streams
+            work_db.commit()
+            events_queue.put(("context", {"parsed_count": parsed_count}))
+            
+            answer = []
+            if not stop.is_set():
+                chunks = ai_analyzer.analyze_data_stream(
+                    request.prompt,
+                    analysis_input["emails"],
+                    analysis_input["documents"],
+                    analysis_input["email_contents"],
+                    analysis_input["document_contents"],
+                    conversation_history=analysis_input["conversation_history"],
+                    relevant_chunks=analysis_input["relevant_chunks"],
+                    use_cache=request.use_cache,
+                    map_reduce=request.map_reduce
+                )
+                try:
+                    for chunk in chunks:
+                        answer.append(chunk)
+                        events_queue.put(("token", chunk))
+                        if stop.is_set():
+                            answer.append("\n\n[Response interrupted]")
+                            break
+                finally:
+                    chunks.close()
+            if stop.is_set():
+                print(f"Client disconnected from analysis stream for thread {thread_id}")
+            
+            message_id = None
+            if answer:
+                message = save_chat_message(work_db, thread_id, project_id, user_id, "assistant", ''.join(answer), parsed_count)
+                work_db.commit()
+                message_id = message.id
+            events_queue.put(("done", message_id))
+        except Exception as e:
+            work_db.rollback()
+            detail = e.detail if isinstance(e, HTTPException) else f"Analysis failed: {str(e)}"
+            print(f"Streamed analysis for thread {thread_id} failed: {detail}")
+            events_queue.put(("error", {"detail": detail}))
+        finally:
+            work_db.close()
+    
+    async def events():
+        threading.Thread(target=run_analysis, daemon=True).start()
+        try:
+            yield sse_event("start", {"thread_id": thread_id})
+            while True:
+                kind, value = await run_in_threadpool(events_queue.get)
+                if kind == "done":
+                    yield sse_event("done", {
+                        "message_id": value,
+                        "thread_id": thread_id,
+                        "parsed_count": outcome["parsed_count"],
+                        "context_usage": ai_analyzer.last_context_usage,
+                        "cached": ai_analyzer.last_cache_hit
+                    })
+                    break
+                if kind == "error":
+                    yield sse_event("error", value)
+                    break
+                yield sse_event(kind, {"delta": value} if kind == "token" else value)
+                if await http_request.is_disconnected():
+                    break
+        finally:
+            stop.set()
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Thread Management Endpoints
 @app.post("/api/threads", response_model=ThreadResponse)
 def create_thread(request: ThreadCreateRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
@@ -1475,21 +1908,10 @@ def send_email_to_contact(contact_id: int, email_request: SendEmailRequest, curr
         raise HTTPException(status_code=400, detail="Contact does not have an email address")
     
     # Get user's Google credentials
-    google_creds = db.query(GoogleCredentials).filter(GoogleCredentials.user_id == current_user.id).first()
-    if not google_creds:
+    credentials = credentials_broker.get_credentials(current_user.id)
+    if not credentials:
         raise HTTPException(status_code=400, detail="Google credentials not found. Please connect your Google account.")
     
-    # Create credentials object
-    from google.oauth2.credentials import Credentials as GoogleCreds
-    credentials = GoogleCreds(
-        token=google_creds.access_token,
-        refresh_token=google_creds.refresh_token,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=GoogleServicesManager().client_id,
-        client_secret=GoogleServicesManager().client_secret,
-        scopes=json.loads(google_creds.scopes)
-    )
-    
     # Send email
     try:
         google_manager = GoogleServicesManager()
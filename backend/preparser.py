@@ -0,0 +1,154 @@
+import os
+import queue
+import itertools
+import threading
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Dict, List
+
+from database import SessionLocal, Project
+from google_services import GoogleServicesManager
+from document_parser import DocumentParser
+from credentials_broker import credentials_broker
+from content_cache import content_cache
+from search_index import search_index
+
+class PreParser:
+    """Background workers that extract project documents and email bodies into the content cache
+    
+    search_project enqueues a project's newest items so analyze_project finds them already parsed.
+    Jobs are ordered newest first across all queued projects and run on PREPARSE_MAX_WORKERS threads.
+    """
+    
+    # 0 disables pre-parsing
+    MAX_WORKERS = int(os.getenv("PREPARSE_MAX_WORKERS", "2"))
+    # Newest emails and documents pre-parsed per search
+    MAX_EMAILS = int(os.getenv("PREPARSE_MAX_EMAILS", "20"))
+    MAX_DOCUMENTS = int(os.getenv("PREPARSE_MAX_DOCUMENTS", "10"))
+    
+    def __init__(self):
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._workers: List[threading.Thread] = []
+        # Item counts: skipped items were already cached or could not be fetched
+        self.stats = {'queued': 0, 'parsed': 0, 'skipped': 0, 'failed': 0}
+    
+    @staticmethod
+    def _timestamp(value: str) -> float:
+        """Sort key for an email Date header or a Drive modifiedTime; unknown dates sort last"""
+        if not value or value == 'Unknown':
+            return 0.0
+        try:
+            return parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            pass
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            return 0.0
+    
+    def _ensure_workers(self):
+        with self._lock:
+            while len(self._workers) < self.MAX_WORKERS:
+                worker = threading.Thread(target=self._run, name=f"preparse-{len(self._workers)}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+    
+    def _put(self, timestamp: float, job: tuple):
+        # Newest first; the sequence number keeps equal timestamps in submission order
+        self._queue.put((-timestamp, next(self._sequence), job))
+    
+    def enqueue_project(self, user_id: int, project_id: int, emails: List[Dict], documents: List[Dict]):
+        """Queue pre-parsing of the newest emails and documents from a project's search results"""
+        if self.MAX_WORKERS <= 0:
+            return
+        emails = sorted(emails, key=lambda email: self._timestamp(email.get('date')), reverse=True)[:self.MAX_EMAILS]
+        documents = sorted(documents, key=lambda doc: self._timestamp(doc.get('modified_time')), reverse=True)[:self.MAX_DOCUMENTS]
+        
+        # Skip items another search already queued
+        with self._lock:
+            emails = [email for email in emails if content_cache.email_key(user_id, email['id']) not in self._in_flight]
+            documents = [
+                doc for doc in documents
+                if content_cache.document_key(user_id, doc['id'], doc.get('modified_time')) not in self._in_flight
+            ]
+            self._in_flight.update(content_cache.email_key(user_id, email['id']) for email in emails)
+            self._in_flight.update(content_cache.document_key(user_id, doc['id'], doc.get('modified_time')) for doc in documents)
+            self.stats['queued'] += len(emails) + len(documents)
+        
+        if not emails and not documents:
+            return
+        self._ensure_workers()
+        
+        # Email bodies are fetched together in Gmail batches, so they form one job ranked by the newest email
+        if emails:
+            self._put(self._timestamp(emails[0].get('date')), ('emails', user_id, project_id, emails))
+        for doc in documents:
+            self._put(self._timestamp(doc.get('modified_time')), ('document', user_id, project_id, [doc]))
+        print(f"Pre-parse queued {len(emails)} emails and {len(documents)} documents for user {user_id}")
+    
+    def _run(self):
+        while True:
+            _, _, (kind, user_id, project_id, items) = self._queue.get()
+            if kind == 'emails':
+                keys = [content_cache.email_key(user_id, email['id']) for email in items]
+            else:
+                keys = [content_cache.document_key(user_id, doc['id'], doc.get('modified_time')) for doc in items]
+            
+            db = SessionLocal()
+            try:
+                if db.get(Project, project_id) is None:
+                    parsed = 0  # Project deleted while the job was queued
+                elif kind == 'emails':
+                    parsed = self._parse_emails(db, user_id, project_id, items)
+                else:
+                    parsed = self._parse_document(db, user_id, project_id, items[0])
+                db.commit()
+                outcome = {'parsed': parsed, 'skipped': len(items) - parsed}
+            except Exception as e:
+                print(f"Pre-parse of {len(items)} {kind} for user {user_id} failed: {e}")
+                db.rollback()
+                outcome = {'failed': len(items)}
+            finally:
+                db.close()
+                with self._lock:
+                    self._in_flight.difference_update(keys)
+                    for name, count in outcome.items():
+                        self.stats[name] += count
+                self._queue.task_done()
+    
+    def _parse_emails(self, db, user_id: int, project_id: int, emails: List[Dict]) -> int:
+        """Fetch and cache the bodies that are not cached yet; returns how many were stored"""
+        missing = [email['id'] for email in emails if not content_cache.contains(db, content_cache.email_key(user_id, email['id']))]
+        if not missing:
+            return 0
+        credentials = credentials_broker.get_credentials(user_id)
+        if not credentials:
+            return 0
+        bodies = GoogleServicesManager().get_email_bodies(credentials, missing)
+        for email_id, content in bodies.items():
+            content_cache.put(db, content_cache.email_key(user_id, email_id), 'email', email_id, content)
+            search_index.index_content(db, project_id, 'email', email_id, content)
+        return len(bodies)
+    
+    def _parse_document(self, db, user_id: int, project_id: int, doc: Dict) -> int:
+        """Parse and store one document for the project unless its text is stored already; returns 1 if parsed"""
+        content = content_cache.get_document(db, project_id, doc['id'], doc.get('modified_time'))
+        if content is not None:
+            search_index.index_content(db, project_id, 'document', doc['id'], content)
+            return 0
+        credentials = credentials_broker.get_credentials(user_id)
+        if not credentials:
+            return 0
+        content = DocumentParser.parse_document(credentials, doc['id'], doc.get('mime_type', ''))
+        content_cache.put_document(db, project_id, doc['id'], doc.get('modified_time'), content)
+        search_index.index_content(db, project_id, 'document', doc['id'], content)
+        return 1
+    
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return dict(self.stats, pending=self._queue.qsize(), in_flight=len(self._in_flight))
+
+preparser = PreParser()
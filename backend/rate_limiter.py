@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import time
+import random
+import threading
+import weakref
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# Per-user quota ceilings, in quota units per second (Gmail) or requests per second (others).
+# Gmail allows 250 units/s per user; Drive, Docs, Sheets and Slides limits are per minute per user.
+API_RATE_LIMITS = {
+    'gmail': float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", "250")),
+    'drive': float(os.getenv("DRIVE_REQUESTS_PER_SECOND", "20")),
+    'docs': float(os.getenv("DOCS_REQUESTS_PER_SECOND", "5")),
+    'sheets': float(os.getenv("SHEETS_REQUESTS_PER_SECOND", "1")),
+    'slides': float(os.getenv("SLIDES_REQUESTS_PER_SECOND", "10")),
+}
+
+# Gmail quota units per method (https://developers.google.com/gmail/api/reference/quota)
+GMAIL_DEFAULT_UNITS = 5
+GMAIL_METHOD_UNITS = [
+    ('/messages/send', 100),
+    ('/history', 2),
+    ('/profile', 1),
+]
+
+MAX_RETRIES = int(os.getenv("GOOGLE_API_MAX_RETRIES", "5"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 32.0
+RETRIABLE_STATUSES = {429, 500, 502, 503, 504}
+# A 5xx can arrive after the request took effect (e.g. a sent email), so only these methods are retried on one
+IDEMPOTENT_METHODS = {'GET', 'HEAD'}
+RATE_LIMIT_REASONS = {'userRateLimitExceeded', 'rateLimitExceeded'}
+
+_BATCH_PART_REQUEST = re.compile(rb'^(GET|POST|PUT|PATCH|DELETE) (\S+)', re.MULTILINE)
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens per second
+    
+    A request bigger than the bucket (e.g. a 100-message Gmail batch) is allowed to
+    borrow against future refills; callers then wait until the debt is repaid.
+    """
+    
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, units: float) -> float:
+        """Reserve units, sleeping until they are available. Returns the seconds waited."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= units
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class GoogleRateLimiter:
+    """Per-user, per-API token buckets plus retry metrics for Google API calls"""
+    
+    def __init__(self):
+        # Buckets are keyed by the user's Credentials object (one per user, see CredentialsBroker)
+        self._buckets = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Dict[str, float]] = {}
+    
+    def bucket(self, credentials, api: str) -> Optional[TokenBucket]:
+        rate = API_RATE_LIMITS.get(api)
+        if not rate:
+            return None
+        with self._lock:
+            user_buckets = self._buckets.setdefault(credentials, {})
+            if api not in user_buckets:
+                user_buckets[api] = TokenBucket(rate)
+            return user_buckets[api]
+    
+    def record(self, api: str, **values):
+        with self._lock:
+            api_metrics = self._metrics.setdefault(api, {
+                'requests': 0,
+                'quota_units': 0,
+                'throttled_seconds': 0.0,
+                'rate_limited_responses': 0,
+                'retries': 0,
+                'backoff_seconds': 0.0,
+                'failures': 0
+            })
+            for name, value in values.items():
+                api_metrics[name] += value
+    
+    def get_metrics(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {api: dict(values) for api, values in self._metrics.items()}
+
+rate_limiter = GoogleRateLimiter()
+
+def request_cost(api: str, uri: str, body=None) -> int:
+    """Quota units consumed by one HTTP request; a batch costs the sum of its parts"""
+    if '/batch' in uri and body:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        parts = _BATCH_PART_REQUEST.findall(body)
+        if parts:
+            return sum(request_cost(api, path.decode('utf-8', 'ignore')) for _, path in parts)
+    if api != 'gmail':
+        return 1
+    path = uri.split('?', 1)[0]
+    return next((units for suffix, units in GMAIL_METHOD_UNITS if path.endswith(suffix)), GMAIL_DEFAULT_UNITS)
+
+def is_idempotent(method: str, uri: str, body=None) -> bool:
+    """True for requests that are safe to repeat; a batch is if all of its parts are"""
+    if '/batch' in uri and body:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        parts = _BATCH_PART_REQUEST.findall(body)
+        return bool(parts) and all(part_method.decode('utf-8') in IDEMPOTENT_METHODS for part_method, _ in parts)
+    return method.upper() in IDEMPOTENT_METHODS
+
+def is_rate_limited(status: int, content, idempotent: bool = True) -> bool:
+    """True for responses that should be retried after backing off
+    
+    429s and 403 rate-limit errors were rejected before taking effect and are always retried;
+    other retriable statuses only for idempotent requests.
+    """
+    if status == 429:
+        return True
+    if status in RETRIABLE_STATUSES:
+        return idempotent
+    if status != 403 or not content:
+        return False
+    try:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        errors = json.loads(content).get('error', {}).get('errors', [])
+        return any(error.get('reason') in RATE_LIMIT_REASONS for error in errors)
+    except (ValueError, AttributeError):
+        return False
+
+def retry_delay(attempt: int, retry_after: str = None) -> float:
+    """Seconds to wait before retry `attempt`: Retry-After if given, else exponential backoff with jitter"""
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)) + random.uniform(0, 1)
+
+class RateLimitedHttp:
+    """httplib2-compatible wrapper that applies the user's token bucket and retries rate-limited responses"""
+    
+    def __init__(self, http, api: str, credentials):
+        self.http = http
+        self.api = api
+        self.bucket = rate_limiter.bucket(credentials, api)
+    
+    def __getattr__(self, name):
+        # googleapiclient reads .credentials, .timeout etc. from the transport
+        return getattr(self.http, name)
+    
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        units = request_cost(self.api, uri, body)
+        idempotent = is_idempotent(method, uri, body)
+        for attempt in range(MAX_RETRIES + 1):
+            waited = self.bucket.acquire(units) if self.bucket else 0.0
+            rate_limiter.record(self.api, requests=1, quota_units=units, throttled_seconds=waited)
+            
+            resp, content = self.http.request(uri, method, body=body, headers=headers, **kwargs)
+            if not is_rate_limited(resp.status, content, idempotent):
+                return resp, content
+            
+            rate_limiter.record(self.api, rate_limited_responses=1)
+            if attempt == MAX_RETRIES:
+                rate_limiter.record(self.api, failures=1)
+                return resp, content
+            
+            delay = retry_delay(attempt, resp.get('retry-after'))
+            print(f"{self.api} API returned {resp.status}, retrying in {delay:.1f}s (attempt {attempt + 1}/{MAX_RETRIES})")
+            rate_limiter.record(self.api, retries=1, backoff_seconds=delay)
+            time.sleep(delay)
@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from database import SessionLocal, CachedResponse, CachedSummary
+
+class ResponseCache:
+    """TTL + LRU cache of AI analysis completions, in memory and optionally in the database
+    
+    Keys cover everything that shapes the completion: model and sampling settings, the system
+    prompt, the packed context, the conversation history and the user's prompt.
+    """
+    
+    TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+    MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "500"))
+    # Also keep responses in the cached_responses table so they survive restarts
+    PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "false").lower() == "true"
+    
+    def __init__(self, model=CachedResponse, ttl_seconds: int = None, max_entries: int = None, persist: bool = None):
+        # Separate instances keep separate limits and tables, so one kind of entry cannot evict another
+        self.model = model
+        if ttl_seconds is not None:
+            self.TTL_SECONDS = ttl_seconds
+        if max_entries is not None:
+            self.MAX_ENTRIES = max_entries
+        if persist is not None:
+            self.PERSIST = persist
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, response)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0, 'bypassed': 0}
+    
+    @staticmethod
+    def _digest(value) -> str:
+        return hashlib.sha256(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    def make_key(self, model: str, settings: Dict, messages: List[Dict], prompt: str) -> str:
+        """Cache key for a chat completion request built by AIAnalyzer.build_messages"""
+        system, history, final = messages[0], messages[1:-1], messages[-1]
+        return self._digest({
+            'model': model,
+            'settings': settings,
+            'system': self._digest(system['content']),
+            'context': self._digest(final['content']),
+            'history': self._digest(history),
+            'prompt': prompt
+        })
+    
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self.stats[name] += value
+    
+    def get(self, key: str) -> Optional[str]:
+        now = datetime.utcnow()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, response = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return response
+                del self._entries[key]
+                self.stats['expired'] += 1
+        
+        response = self._load(key, now) if self.PERSIST else None
+        if response is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return response
+    
+    def put(self, key: str, model: str, response: str, ttl_seconds: int = None):
+        if not response:
+            return
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl_seconds or self.TTL_SECONDS)
+        self._remember(key, expires_at, response)
+        self._count('stores')
+        if self.PERSIST:
+            self._save(key, model, expires_at, response)
+    
+    def bypass(self):
+        """Record a request that skipped the cache"""
+        self._count('bypassed')
+    
+    def _remember(self, key: str, expires_at: datetime, response: str):
+        with self._lock:
+            self._entries[key] = (expires_at, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+    
+    def _load(self, key: str, now: datetime) -> Optional[str]:
+        """Read a persisted response into memory"""
+        db = SessionLocal()
+        try:
+            entry = db.query(self.model).filter(self.model.cache_key == key).first()
+            if entry is None:
+                return None
+            if entry.expires_at <= now:
+                db.delete(entry)
+                db.commit()
+                self._count('expired')
+                return None
+            entry.last_accessed = now
+            db.commit()
+            self._remember(key, entry.expires_at, entry.response)
+            return entry.response
+        except Exception as e:
+            print(f"Response cache read failed: {e}")
+            db.rollback()
+            return None
+        finally:
+            db.close()
+    
+    def _save(self, key: str, model: str, expires_at: datetime, response: str):
+        db = SessionLocal()
+        try:
+            entry = db.query(self.model).filter(self.model.cache_key == key).first()
+            if entry is None:
+                entry = self.model(cache_key=key, model=model)
+                db.add(entry)
+            entry.response = response
+            entry.expires_at = expires_at
+            entry.last_accessed = datetime.utcnow()
+            db.flush()
+            
+            # Drop expired rows, then the least recently used beyond MAX_ENTRIES
+            db.query(self.model).filter(self.model.expires_at <= datetime.utcnow()).delete(synchronize_session=False)
+            stale_ids = [
+                entry_id for (entry_id,) in db.query(self.model.id).order_by(
+                    self.model.last_accessed.desc()
+                ).offset(self.MAX_ENTRIES)
+            ]
+            if stale_ids:
+                db.query(self.model).filter(self.model.id.in_(stale_ids)).delete(synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            # e.g. SQLite locked by another writer - the response is still cached in memory
+            print(f"Response cache write failed: {e}")
+            db.rollback()
+        finally:
+            db.close()
+    
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), max_entries=self.MAX_ENTRIES,
+                        ttl_seconds=self.TTL_SECONDS, persist=self.PERSIST)
+
+response_cache = ResponseCache()
+
+# Map-reduce batch summaries are reused across analyses and restarts, so they get their own
+# table and limits instead of competing with whole answers for RESPONSE_CACHE_MAX_ENTRIES
+summary_cache = ResponseCache(
+    model=CachedSummary,
+    ttl_seconds=int(os.getenv("ANALYSIS_MAP_SUMMARY_TTL_SECONDS", str(7 * 24 * 3600))),
+    max_entries=int(os.getenv("ANALYSIS_MAP_SUMMARY_MAX_ENTRIES", "5000")),
+    persist=os.getenv("ANALYSIS_MAP_SUMMARY_PERSIST", "true").lower() == "true"
+)
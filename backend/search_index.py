@@ -0,0 +1,161 @@
+import os
+import re
+import math
+import hashlib
+from collections import Counter
+from typing import Dict, List, Tuple
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+
+from database import IndexChunk, IndexPosting
+
+STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'has', 'have', 'i', 'if', 'in',
+    'is', 'it', 'its', 'me', 'my', 'of', 'on', 'or', 'our', 'so', 'that', 'the', 'their', 'them', 'there',
+    'they', 'this', 'to', 'was', 'we', 'were', 'what', 'when', 'which', 'who', 'will', 'with', 'you', 'your'
+}
+
+_TERM = re.compile(r"[a-z0-9]+")
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word terms without stop words"""
+    return [term for term in _TERM.findall((text or '').lower()) if term not in STOP_WORDS and len(term) > 1]
+
+class SearchIndex:
+    """Per-project BM25 index over email and document text, stored in index_chunks / index_postings
+    
+    Every email and document gets a metadata chunk when search results come in; bodies and
+    parsed document text are added as chunks of CHUNK_WORDS words when they are extracted.
+    Like ContentCache, it writes through the caller's session and never commits.
+    """
+    
+    CHUNK_WORDS = int(os.getenv("INDEX_CHUNK_WORDS", "200"))
+    # BM25 parameters
+    K1 = 1.5
+    B = 0.75
+    
+    @staticmethod
+    def email_metadata(email: Dict) -> str:
+        return (f"Subject: {email.get('subject', 'No Subject')}\nFrom: {email.get('from_', 'Unknown')}\n"
+                f"Date: {email.get('date', 'Unknown')}\n{email.get('snippet', '')}")
+    
+    @staticmethod
+    def document_metadata(doc: Dict) -> str:
+        return f"Document: {doc.get('name', 'Untitled')}\nType: {doc.get('type', 'Unknown')}\nModified: {doc.get('modified_time', 'Unknown')}"
+    
+    def _add_chunks(self, db: Session, project_id: int, chunks: List[Tuple[str, str, int, str, str]]):
+        """Insert (source_type, source_id, chunk_index, content, content_hash) chunks with their postings"""
+        rows = []
+        for source_type, source_id, chunk_index, content, content_hash in chunks:
+            terms = Counter(tokenize(content))
+            chunk = IndexChunk(
+                project_id=project_id, source_type=source_type, source_id=source_id,
+                chunk_index=chunk_index, content=content, length=sum(terms.values()), content_hash=content_hash
+            )
+            rows.append((chunk, terms))
+        db.add_all([chunk for chunk, _ in rows])
+        db.flush()
+        postings = [
+            {'project_id': project_id, 'term': term, 'chunk_id': chunk.id, 'frequency': frequency}
+            for chunk, terms in rows for term, frequency in terms.items()
+        ]
+        if postings:
+            db.execute(insert(IndexPosting), postings)
+    
+    def _delete_chunks(self, db: Session, chunk_ids: List[int]):
+        if not chunk_ids:
+            return
+        db.query(IndexPosting).filter(IndexPosting.chunk_id.in_(chunk_ids)).delete(synchronize_session=False)
+        db.query(IndexChunk).filter(IndexChunk.id.in_(chunk_ids)).delete(synchronize_session=False)
+    
+    def index_items(self, db: Session, project_id: int, emails: List[Dict], documents: List[Dict]) -> int:
+        """Add metadata chunks for search results not indexed yet; returns how many were added"""
+        indexed = {
+            (source_type, source_id) for source_type, source_id in db.query(IndexChunk.source_type, IndexChunk.source_id).filter(
+                IndexChunk.project_id == project_id,
+                IndexChunk.chunk_index == 0
+            )
+        }
+        chunks = [
+            ('email', email['id'], 0, self.email_metadata(email), None)
+            for email in emails if ('email', email['id']) not in indexed
+        ] + [
+            ('document', doc['id'], 0, self.document_metadata(doc), None)
+            for doc in documents if ('document', doc['id']) not in indexed
+        ]
+        if chunks:
+            self._add_chunks(db, project_id, chunks)
+        return len(chunks)
+    
+    def index_content(self, db: Session, project_id: int, source_type: str, source_id: str, content: str):
+        """Index an email body or document text in CHUNK_WORDS-word chunks, replacing older text of the same item"""
+        if not content:
+            return
+        content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        existing = db.query(IndexChunk.id, IndexChunk.content_hash).filter(
+            IndexChunk.project_id == project_id,
+            IndexChunk.source_type == source_type,
+            IndexChunk.source_id == source_id,
+            IndexChunk.chunk_index > 0
+        ).all()
+        if existing and all(digest == content_hash for _, digest in existing):
+            return
+        self._delete_chunks(db, [chunk_id for chunk_id, _ in existing])
+        
+        words = content.split()
+        chunks = [
+            (source_type, source_id, number, ' '.join(words[start:start + self.CHUNK_WORDS]), content_hash)
+            for number, start in enumerate(range(0, len(words), self.CHUNK_WORDS), 1)
+        ]
+        if chunks:
+            self._add_chunks(db, project_id, chunks)
+    
+    def remove_project(self, db: Session, project_id: int):
+        db.query(IndexPosting).filter(IndexPosting.project_id == project_id).delete(synchronize_session=False)
+        db.query(IndexChunk).filter(IndexChunk.project_id == project_id).delete(synchronize_session=False)
+    
+    def search(self, db: Session, project_id: int, query: str, limit: int) -> List[Dict]:
+        """Return the project's chunks ranked by BM25 score for query, best first"""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        chunk_count, average_length = db.query(
+            func.count(IndexChunk.id), func.avg(IndexChunk.length)
+        ).filter(IndexChunk.project_id == project_id).one()
+        if not chunk_count:
+            return []
+        average_length = average_length or 1
+        
+        document_frequency = dict(db.query(IndexPosting.term, func.count(IndexPosting.id)).filter(
+            IndexPosting.project_id == project_id,
+            IndexPosting.term.in_(terms)
+        ).group_by(IndexPosting.term))
+        idf = {
+            term: math.log(1 + (chunk_count - count + 0.5) / (count + 0.5))
+            for term, count in document_frequency.items()
+        }
+        
+        scores = Counter()
+        for chunk_id, term, frequency, length in db.query(
+            IndexPosting.chunk_id, IndexPosting.term, IndexPosting.frequency, IndexChunk.length
+        ).join(IndexChunk, IndexChunk.id == IndexPosting.chunk_id).filter(
+            IndexPosting.project_id == project_id,
+            IndexPosting.term.in_(terms)
+        ):
+            norm = self.K1 * (1 - self.B + self.B * (length or 0) / average_length)
+            scores[chunk_id] += idf[term] * frequency * (self.K1 + 1) / (frequency + norm)
+        
+        top = scores.most_common(limit)
+        chunks = {chunk.id: chunk for chunk in db.query(IndexChunk).filter(IndexChunk.id.in_([chunk_id for chunk_id, _ in top]))}
+        return [
+            {
+                'source_type': chunks[chunk_id].source_type,
+                'source_id': chunks[chunk_id].source_id,
+                'chunk_index': chunks[chunk_id].chunk_index,
+                'content': chunks[chunk_id].content,
+                'score': round(score, 4)
+            }
+            for chunk_id, score in top
+        ]
+
+search_index = SearchIndex()